@@ -0,0 +1,92 @@
+"""
+Batching reader for the song files. Every song file holds a single JSON record,
+so reading them one by one with `pd.read_json` is dominated by per-file
+overhead. The reader parses the files line by line with the json module and
+coalesces `batch_size` files into one DataFrame.
+"""
+
+import json
+import time
+import pandas as pd
+from metrics import metrics, source_label
+
+song_data_columns = ["num_songs",
+                     "artist_id",
+                     "artist_latitude",
+                     "artist_longitude",
+                     "artist_location",
+                     "artist_name",
+                     "song_id",
+                     "title",
+                     "duration",
+                     "year",
+                     ]
+
+
+def read_song_batch(filepaths):
+    """Read the records of a list of song files into one DataFrame."""
+    records = []
+    for filepath in filepaths:
+        with open(filepath, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+    return pd.DataFrame.from_records(records, columns=song_data_columns)
+
+
+def split_batches(all_files, batch_size):
+    """Split a list of files into lists of at most batch_size files."""
+    return [all_files[i:i + batch_size]
+            for i in range(0, len(all_files), batch_size)
+            ]
+
+
+class SongFileBatchReader:
+    """Iterate over song files in batches of DataFrames.
+
+    Parameters
+    ----------
+    all_files : list
+        Paths of the song files to read
+    batch_size : int
+        Number of files coalesced into one DataFrame
+
+    The counters `files_read` and `rows_read` and the rates `files_per_sec`
+    and `rows_per_sec` cover the wall time since the first batch was
+    requested, i.e. including the time the consumer spends on each batch.
+    """
+
+    def __init__(self, all_files, batch_size=1000):
+        self.all_files = all_files
+        self.batch_size = batch_size
+        self.files_read = 0
+        self.rows_read = 0
+        self.start_time = None
+
+    def __len__(self):
+        return len(self.all_files)
+
+    def __iter__(self):
+        self.start_time = time.perf_counter()
+        for batch in split_batches(self.all_files, self.batch_size):
+            with metrics.source(source_label(batch)), \
+                    metrics.stage("read") as stage:
+                df = read_song_batch(batch)
+                stage["rows"] = len(df)
+            self.files_read += len(batch)
+            self.rows_read += len(df)
+            yield df
+
+    @property
+    def elapsed(self):
+        if self.start_time is None:
+            return 0.0
+        return time.perf_counter() - self.start_time
+
+    @property
+    def files_per_sec(self):
+        return self.files_read / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def rows_per_sec(self):
+        return self.rows_read / self.elapsed if self.elapsed else 0.0
@@ -0,0 +1,93 @@
+"""
+Benchmark of the peak memory (RSS) of processing a log file in relation to its
+size, comparing whole-file reads with the streaming mode of `process_log_file`.
+
+Every measurement runs in a fresh subprocess, so the peak RSS of one run does
+not carry over to the next. By default only reading and transforming is
+measured; with `--load` the file is also loaded into the database (in a
+transaction that is rolled back afterwards). Uses the resource module, so it
+runs on Linux and macOS only.
+
+    python bench_memory.py --sizes 10000 100000 1000000 --chunksize 10000
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from functools import partial
+from benchmark import rss_mb
+from generate_data import write_log_file
+
+
+def measure(filepath, chunksize, load):
+    """Process a log file and print the peak RSS as JSON (subprocess side)."""
+    import pandas as pd
+    import etl
+
+    if load:
+        from db_connect import connect, close
+        from song_lookup import SongLookup
+        cur, conn = connect(autocommit=False)
+        etl.process_log_file(cur, filepath, bulk=True,
+                             lookup=SongLookup.from_db(cur),
+                             chunksize=chunksize)
+        conn.rollback()
+        close(cur, conn)
+    elif chunksize is None:
+        etl.prepare_log_file(filepath)
+    else:
+        reader = pd.read_json(filepath, lines=True, chunksize=chunksize)
+        for df in reader:
+            etl.transform_log_data(df, source_file=filepath)
+        reader.close()
+
+    print(json.dumps({"peak_rss_mb": rss_mb(resource.RUSAGE_SELF)}))
+
+
+def run_measurement(filepath, chunksize, load):
+    """Run a measurement in a subprocess and return the peak RSS in MB."""
+    cmd = [sys.executable, __file__, "--measure", filepath]
+    if chunksize is not None:
+        cmd += ["--chunksize", str(chunksize)]
+    if load:
+        cmd.append("--load")
+    output = subprocess.run(cmd, check=True, capture_output=True, text=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])["peak_rss_mb"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure peak RSS of log processing versus file size."
+    )
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[10000, 100000, 1000000],
+                        help="number of events per generated log file")
+    parser.add_argument("--chunksize", type=int, default=None,
+                        help="chunk size of the streaming mode (default: 10000)")
+    parser.add_argument("--load", action="store_true",
+                        help="also load the file into the database")
+    parser.add_argument("--measure", metavar="FILE", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure, args.chunksize, args.load)
+        return
+    chunksize = args.chunksize or 10000
+
+    print(f"{'events':>10} {'file MB':>9} {'whole MB':>9} {'stream MB':>10}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            filepath = os.path.join(tmp_dir, f"{size}-events.json")
+            write_log_file(filepath, size)
+            run = partial(run_measurement, filepath, load=args.load)
+            whole, stream = run(None), run(chunksize)
+            file_mb = os.path.getsize(filepath) / 1024 ** 2
+            print(f"{size:>10} {file_mb:>9.1f} {whole:>9.1f} {stream:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
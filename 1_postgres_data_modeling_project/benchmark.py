@@ -0,0 +1,172 @@
+"""
+Benchmark of the Postgres ETL. Generates a synthetic song_data and log_data
+tree, runs etl.py on it in one or more loader modes and reports files/sec,
+rows/sec, time spent per table, peak RSS and the number of database round
+trips. The results are saved as JSON, so loader modes and runs over time can
+be compared.
+
+Every mode runs with `--full-refresh`, i.e. truncates all tables of the
+database configured in database.ini first. Don't point it at data you want
+to keep. Peak RSS is measured with the resource module (Linux and macOS).
+
+    python benchmark.py --songs 10000 --events 100000 --modes row bulk
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from generate_data import generate_data
+
+# Command line arguments of etl.py per loader mode
+modes = {
+    "row": [],
+    "bulk": ["--bulk"],
+    "bulk-batch": ["--bulk", "--batch-size", "1000"],
+    "bulk-stream": ["--bulk", "--batch-size", "1000", "--chunksize", "10000"],
+    "bulk-parallel": ["--bulk", "--batch-size", "1000", "--workers", "4"],
+}
+
+tables = ["songplays", "users", "songs", "artists", "time"]
+
+
+def rss_mb(who):
+    """Return the peak resident set size in MB of this process or of its
+    largest terminated child process.
+    """
+    peak = resource.getrusage(who).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes on Linux
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def run_etl(etl_args):
+    """Run the ETL in this process and print its measurements as JSON
+    (subprocess side). The progress output of the ETL is discarded.
+    """
+    import etl
+
+    sys.argv = ["etl.py", *etl_args]
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        etl.main()
+    print(json.dumps({"wall_time_s": time.perf_counter() - start,
+                      "peak_rss_mb": rss_mb(resource.RUSAGE_SELF),
+                      "children_peak_rss_mb": rss_mb(resource.RUSAGE_CHILDREN),
+                      }))
+
+
+def count_files(data_dir):
+    """Return the number of JSON files in a data directory."""
+    return sum(1 for root, dirs, files in os.walk(data_dir)
+               for f in files if f.endswith(".json"))
+
+
+def count_rows():
+    """Return the number of rows per table."""
+    from db_connect import connect, close
+
+    cur, conn = connect()
+    rows = {}
+    for table in tables:
+        cur.execute(f"SELECT COUNT(*) FROM {table};")
+        rows[table] = cur.fetchone()[0]
+    close(cur, conn)
+    return rows
+
+
+def run_mode(mode, data_dir):
+    """Run etl.py in a fresh subprocess in the given mode and return the
+    measurements of the run.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        stats_file = os.path.join(tmp_dir, "stats.json")
+        etl_args = [*modes[mode], "--full-refresh", "--data-dir", data_dir,
+                    "--stats", stats_file]
+        output = subprocess.run(
+            [sys.executable, __file__, "--run-etl", *etl_args],
+            check=True, capture_output=True, text=True
+        )
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        with open(stats_file) as f:
+            stats = json.load(f)
+
+    num_files = count_files(data_dir)
+    rows = count_rows()
+    wall_time = result["wall_time_s"]
+    return {"mode": mode,
+            "etl_args": modes[mode],
+            **result,
+            "files": num_files,
+            "files_per_sec": num_files / wall_time,
+            "rows": rows,
+            "rows_per_sec": sum(rows.values()) / wall_time,
+            "round_trips": stats["round_trips"],
+            "round_trips_per_table": stats["round_trips_per_table"],
+            "seconds_per_table": stats["seconds_per_table"],
+            }
+
+
+def main():
+    if sys.argv[1:2] == ["--run-etl"]:
+        run_etl(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Postgres ETL on synthetic data."
+    )
+    parser.add_argument("--songs", type=int, default=10000,
+                        help="number of generated song files (default: 10000)")
+    parser.add_argument("--events", type=int, default=100000,
+                        help="number of generated log events (default: 100000)")
+    parser.add_argument("--users", type=int, default=100,
+                        help="number of distinct users (default: 100)")
+    parser.add_argument("--events-per-day", type=int, default=2880,
+                        help="events per daily log file (default: 2880)")
+    parser.add_argument("--modes", nargs="+", choices=list(modes),
+                        default=list(modes), help="loader modes to run")
+    parser.add_argument("--data-dir",
+                        help="use an existing data tree instead of generating one")
+    parser.add_argument("--output", default="benchmark_results.json",
+                        help="JSON file to save the results to")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir or tmp_dir
+        if args.data_dir is None:
+            print(f"Generating {args.songs} songs and {args.events} events ...")
+            generate_data(tmp_dir, args.songs, args.events, args.users,
+                          args.events_per_day)
+
+        runs = []
+        for mode in args.modes:
+            print(f"Running mode {mode} ...")
+            run = run_mode(mode, data_dir)
+            print(f"  {run['wall_time_s']:.1f} s, "
+                  f"{run['files_per_sec']:.0f} files/s, "
+                  f"{run['rows_per_sec']:.0f} rows/s, "
+                  f"{run['round_trips']} round trips, "
+                  f"peak RSS {run['peak_rss_mb']:.0f} MB")
+            runs.append(run)
+
+    results = {"created_at": datetime.now().isoformat(timespec="seconds"),
+               "scale": {"songs": args.songs,
+                         "events": args.events,
+                         "users": args.users,
+                         "events_per_day": args.events_per_day,
+                         "data_dir": args.data_dir,
+                         },
+               "runs": runs,
+               }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
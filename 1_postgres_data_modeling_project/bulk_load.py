@@ -0,0 +1,51 @@
+"""
+Helpers for the bulk load mode of the ETL pipeline. Instead of issuing one
+INSERT per row, the rows of a DataFrame are written to an in-memory CSV buffer
+and streamed into Postgres with a single `COPY ... FROM STDIN`. Dimension
+tables are upserted by copying into a temporary staging table first and merging
+the staged rows with one `INSERT ... ON CONFLICT` statement.
+"""
+
+import io
+import sql_queries as sql
+
+# Marker for missing values, must match the NULL option in sql.copy_from_stdin
+NULL_MARKER = "\\N"
+
+
+def copy_df(cur, df, table):
+    """Stream all rows of a DataFrame into a table using COPY FROM STDIN.
+
+    The DataFrame columns have to be named like the columns of the table.
+    """
+    if df.empty:
+        return
+    buffer = io.StringIO()
+    df.to_csv(buffer, header=False, index=False, na_rep=NULL_MARKER)
+    buffer.seek(0)
+
+    query = sql.copy_from_stdin.format(table=table, columns=", ".join(df.columns))
+    cur.copy_expert(query, buffer)
+
+
+def upsert_df(cur, df, table, merge_query):
+    """Copy a DataFrame into a temp staging table and merge it into the table.
+
+    Parameters
+    ----------
+    cur : psycopg2 cursor
+    df : DataFrame
+        Rows to upsert, columns named like the columns of the table.
+    table : string
+        Name of the target table. The staging table is called `stage_<table>`
+        and lives until the session ends.
+    merge_query : string
+        `INSERT ... SELECT ... FROM stage_<table> ON CONFLICT ...` statement
+    """
+    if df.empty:
+        return
+    staging = f"stage_{table}"
+    cur.execute(sql.staging_table_create.format(staging=staging, table=table))
+    cur.execute(sql.staging_table_truncate.format(staging=staging))
+    copy_df(cur, df, staging)
+    cur.execute(merge_query)
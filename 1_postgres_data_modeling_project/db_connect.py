@@ -1,9 +1,16 @@
 # The aproach here has been inspired by:
 # https://www.postgresqltutorial.com/postgresql-python/connect/
 
+import os
+import sys
 import psycopg2
 from configparser import ConfigParser
 
+# The connection pool is shared with the other projects, see db_pool.py in
+# the repository root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from db_pool import ConnectionPool, is_healthy, named_cursor  # noqa: E402,F401
+
 
 def config(filename="database.ini", section="postgresql"):
     # Create a parser to read config file
@@ -22,25 +29,24 @@ def config(filename="database.ini", section="postgresql"):
     return db_params
 
 
-def connect():
-    """ Connect to the PostgreSQL database server. Return cursor and connection."""
-    conn = None
-    try:
-        # Read connection parameters
-        db_params = config()
-        # Connect to the PostgreSQL server
-        print("Connecting to the PostgreSQL database...")
-        conn = psycopg2.connect(**db_params)
-        # Set auto commit so that each action is commited without calling conn.commit()
-        conn.set_session(autocommit=True)
-        # Create a cursor
-        cur = conn.cursor()
-        print("Success!")
-
-        return cur, conn
-
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
+def connect(autocommit=True, cursor_factory=None):
+    """ Connect to the PostgreSQL database server. Return cursor and connection.
+
+    With autocommit (default) each action is commited without calling
+    conn.commit(). Errors are raised, not swallowed. An optional psycopg2
+    cursor subclass can be passed as default cursor_factory.
+    """
+    # Read connection parameters
+    db_params = config()
+    # Connect to the PostgreSQL server
+    print("Connecting to the PostgreSQL database...")
+    conn = psycopg2.connect(**db_params, cursor_factory=cursor_factory)
+    conn.set_session(autocommit=autocommit)
+    # Create a cursor
+    cur = conn.cursor()
+    print("Success!")
+
+    return cur, conn
 
 
 def close(cur, conn):
@@ -1,69 +1,92 @@
+import argparse
+import json
 import os
 import glob
+from functools import partial
 import pandas as pd
 import sql_queries as sql
-from db_connect import get_connection
+from batch_reader import SongFileBatchReader, read_song_batch, split_batches
+from bulk_load import copy_df, upsert_df
+from db_connect import ConnectionPool, config, connect, close
+from manifest import FileManifest
+from metrics import metrics, source_label
+from parallel import process_data_parallel
+from query_stats import CountingCursor, query_stats
+from song_lookup import SongLookup
 
 
-def process_song_file(cur, filepath):
-    """Process a given song file and load data to database."""
-    # Open song file
-    df = pd.read_json(filepath, lines=True)
-
-    # Insert a song record
+def transform_song_data(df):
+    """Extract the song and artist records from a song data DataFrame."""
     song_cols = ["song_id", "title", "artist_id", "year", "duration"]
-    song_data = df[song_cols].values[0].tolist()
-    cur.execute(sql.song_table_insert, song_data)
-
-    # Insert an artist record
-    artist_cols = ["artist_id",
-                   "artist_name",
-                   "artist_location",
-                   "artist_latitude",
-                   "artist_longitude",
-                   ]
-    artist_data = df[artist_cols].values[0].tolist()
-    cur.execute(sql.artist_table_insert, artist_data)
-
-
-def process_log_file(cur, filepath):
-    """Process a given log file and load data to database."""
-    # Open log file
-    df = pd.read_json(filepath, lines=True)
+    songs_df = df[song_cols].drop_duplicates("song_id")
+
+    artist_cols = {"artist_id": "artist_id",
+                   "artist_name": "name",
+                   "artist_location": "location",
+                   "artist_latitude": "latitude",
+                   "artist_longitude": "longitude",
+                   }
+    artists_df = (df[list(artist_cols)]
+                  .rename(columns=artist_cols)
+                  .drop_duplicates("artist_id")
+                  )
+
+    return songs_df, artists_df
+
+
+def build_time_table(start_times):
+    """Return the time dimension records for the distinct values of a
+    datetime Series, with all calendar attributes computed vectorized.
+    """
+    start_times = pd.Series(pd.unique(start_times.values), name="start_time")
+    dt = start_times.dt
+    if hasattr(dt, "isocalendar"):
+        week = dt.isocalendar()["week"].astype("int64").values
+    else:
+        # pandas < 1.1, Series.dt.week is deprecated in later versions
+        week = dt.week.values
+
+    return pd.DataFrame({"start_time": start_times,
+                         "hour": dt.hour,
+                         "day": dt.day,
+                         "week": week,
+                         "month": dt.month,
+                         "year": dt.year,
+                         "weekday": dt.weekday,
+                         })
+
+
+def transform_log_data(df, source_file=None):
+    """Filter a log data DataFrame for song plays and extract the time and
+    user records. Return time, user and filtered event DataFrames.
+    """
     # Filter by NextSong action
-    df = df.loc[df["page"] == "NextSong"]
+    df = df.loc[df["page"] == "NextSong"].copy()
+    df["source_file"] = source_file
     # Convert timestamp column to datetime
     df["ts"] = pd.to_datetime(df["ts"], unit="ms")
+    df["userId"] = df["userId"].astype(int)
 
-    # Extract data for time table
-    time_data = [df["ts"],
-                 df["ts"].dt.hour,
-                 df["ts"].dt.day,
-                 df["ts"].dt.week,
-                 df["ts"].dt.month,
-                 df["ts"].dt.year,
-                 df["ts"].dt.weekday,
-                 ]
-    cols = ["timestamp",
-            "hour",
-            "day",
-            "week",
-            "month",
-            "year",
-            "weekday",
-            ]
-    time_df = pd.DataFrame(dict(zip(cols, time_data)))
-    # Insert data for time table
-    for i, row in time_df.iterrows():
-        cur.execute(sql.time_table_insert, list(row))
+    # Extract data for time table, one record per distinct timestamp
+    time_df = build_time_table(df["ts"])
 
     # Load user table (simply select the respective columns)
-    user_df = df[["userId", "firstName", "lastName", "gender", "level"]]
-    # Insert user records
-    for i, row in user_df.iterrows():
-        cur.execute(sql.user_table_insert, row)
+    user_cols = {"userId": "user_id",
+                 "firstName": "first_name",
+                 "lastName": "last_name",
+                 "gender": "gender",
+                 "level": "level",
+                 }
+    user_df = df[list(user_cols)].rename(columns=user_cols)
 
-    # Insert songplay records
+    return time_df, user_df, df
+
+
+def select_songs(cur, df):
+    """Return a copy of a log DataFrame with song_id and artist_id columns,
+    querying the song and artist tables once per event.
+    """
+    results = []
     for index, row in df.iterrows():
         # Get songid and artistid from song and artist tables
         cur.execute(sql.song_select, (row["song"],
@@ -71,51 +94,421 @@ def process_log_file(cur, filepath):
                                       row["length"]
                                       )
                     )
-        results = cur.fetchone()
-        if results:
-            songid, artistid = results
-        else:
-            songid, artistid = None, None
-        # Insert songplay record
-        songplay_data = [row["ts"],
-                         row["userId"],
-                         row["level"],
-                         songid,
-                         artistid,
-                         row["sessionId"],
-                         row["location"],
-                         row["userAgent"],
-                         ]
-        cur.execute(sql.songplay_table_insert, songplay_data)
-
-
-def process_data(cur, conn, filepath, func):
-    """Process each data file in a give filepath using the passed function."""
-    # Get all files matching extension from directory
+        results.append(cur.fetchone() or (None, None))
+
+    df = df.copy()
+    df["song_id"] = [songid for songid, artistid in results]
+    df["artist_id"] = [artistid for songid, artistid in results]
+    return df
+
+
+def get_files(filepath):
+    """Return the absolute paths of all JSON files in a directory tree."""
     all_files = []
     for root, dirs, files in os.walk(filepath):
         files = glob.glob(os.path.join(root, '*.json'))
         for f in files :
             all_files.append(os.path.abspath(f))
+    return all_files
+
+
+def get_new_files(cur, filepath, manifest=None):
+    """Return all JSON files in a directory tree, or only the new and changed
+    ones if a FileManifest is passed.
+    """
+    all_files = get_files(filepath)
+    if manifest is None:
+        return all_files
+
+    new_files = manifest.select_files(cur, all_files)
+    print(f"{len(all_files) - len(new_files)} unchanged files skipped "
+          f"in {filepath}.")
+    return new_files
+
+
+def read_json_file(filepath):
+    """Read a newline delimited JSON file, timed as read stage."""
+    with metrics.stage("read") as stage:
+        df = pd.read_json(filepath, lines=True)
+        stage["rows"] = len(df)
+    return df
+
+
+def prepare_song_file(filepath):
+    """Read a given song file and return its song and artist records."""
+    df = read_json_file(filepath)
+    with metrics.stage("transform") as stage:
+        songs_df, artists_df = transform_song_data(df)
+        stage["rows"] = len(songs_df) + len(artists_df)
+    return songs_df, artists_df
+
+
+def prepare_song_batch(filepaths):
+    """Read a batch of song files and return its unique song and artist
+    records.
+    """
+    with metrics.stage("read") as stage:
+        df = read_song_batch(filepaths)
+        stage["rows"] = len(df)
+    with metrics.stage("transform") as stage:
+        songs_df, artists_df = transform_song_data(df)
+        stage["rows"] = len(songs_df) + len(artists_df)
+    return songs_df, artists_df
+
+
+def load_song_data(cur, songs_df, artists_df, bulk=False):
+    """Load song and artist records to database.
+
+    In bulk mode the records are copied into staging tables and merged,
+    otherwise they are inserted row by row.
+    """
+    # Artists repeat across files. Sorting by key makes concurrent
+    # transactions lock the rows in the same order.
+    songs_df = songs_df.sort_values("song_id")
+    artists_df = artists_df.sort_values("artist_id")
+
+    with metrics.stage("insert") as stage:
+        stage["rows"] = len(songs_df) + len(artists_df)
+        if bulk:
+            upsert_df(cur, songs_df, "songs", sql.song_table_merge)
+            upsert_df(cur, artists_df, "artists", sql.artist_table_merge)
+            return
+
+        # Insert song records
+        for song_data in songs_df.values.tolist():
+            cur.execute(sql.song_table_insert, song_data)
+        # Insert artist records
+        for artist_data in artists_df.values.tolist():
+            cur.execute(sql.artist_table_insert, artist_data)
+
+
+def update_lookup(lookup, df):
+    """Add the songs of a song data DataFrame to the lookup, if one is passed."""
+    if lookup is None:
+        return
+    with metrics.stage("lookup") as stage:
+        lookup.update(df)
+        stage["rows"] = len(df)
+
+
+def process_song_file(cur, filepath, bulk=False, lookup=None):
+    """Process a given song file and load data to database. If a SongLookup
+    is passed, the songs are added to it.
+    """
+    # Open song file
+    df = read_json_file(filepath)
+    update_lookup(lookup, df)
+    with metrics.stage("transform") as stage:
+        songs_df, artists_df = transform_song_data(df)
+        stage["rows"] = len(songs_df) + len(artists_df)
+    load_song_data(cur, songs_df, artists_df, bulk=bulk)
+
+
+def process_song_batches(cur, conn, filepath, batch_size, bulk=False,
+                         lookup=None, manifest=None):
+    """Process the song files in a given filepath in batches of files, one
+    transaction per batch. If a SongLookup is passed, the songs are added
+    to it. If a FileManifest is passed, only new and changed files are
+    processed and recorded.
+    """
+    all_files = get_new_files(cur, filepath, manifest)
+    reader = SongFileBatchReader(all_files, batch_size)
+    print(f"{len(reader)} files found in {filepath}.")
+
+    for batch, df in zip(split_batches(all_files, batch_size), reader):
+        with metrics.source(source_label(batch)):
+            update_lookup(lookup, df)
+            with metrics.stage("transform") as stage:
+                songs_df, artists_df = transform_song_data(df)
+                stage["rows"] = len(songs_df) + len(artists_df)
+            load_song_data(cur, songs_df, artists_df, bulk=bulk)
+            if manifest is not None:
+                manifest.record(cur, batch)
+            conn.commit()
+        print(f"{reader.files_read}/{len(reader)} files processed "
+              f"({reader.files_per_sec:.0f} files/s, "
+              f"{reader.rows_per_sec:.0f} rows/s).")
+
+
+def prepare_log_file(filepath):
+    """Read a given log file and return its time, user and song play events."""
+    df = read_json_file(filepath)
+    with metrics.stage("transform") as stage:
+        time_df, user_df, df = transform_log_data(df, source_file=filepath)
+        stage["rows"] = len(df)
+    return time_df, user_df, df
+
+
+def load_log_data(cur, time_df, user_df, df, bulk=False, lookup=None):
+    """Load time, user and songplay records to database.
+
+    In bulk mode every table is loaded with a single COPY (plus merge for
+    the dimension tables), otherwise the records are inserted row by row.
+    Song and artist ids are resolved with the SongLookup if one is passed,
+    otherwise with one query per event.
+    """
+    # Last event of a user determines the level. Sorting by key makes
+    # concurrent transactions lock the rows in the same order.
+    user_df = (user_df
+               .drop_duplicates("user_id", keep="last")
+               .sort_values("user_id")
+               )
+
+    with metrics.stage("insert") as stage:
+        stage["rows"] = len(time_df) + len(user_df)
+        if bulk:
+            upsert_df(cur, time_df, "time", sql.time_table_merge)
+            upsert_df(cur, user_df, "users", sql.user_table_merge)
+        else:
+            # Insert data for time table
+            for time_data in time_df.values.tolist():
+                cur.execute(sql.time_table_insert, time_data)
+            # Insert user records
+            for user_data in user_df.values.tolist():
+                cur.execute(sql.user_table_insert, user_data)
+
+    # Get songid and artistid for all events
+    with metrics.stage("lookup") as stage:
+        if lookup is not None:
+            df = lookup.resolve(df)
+        else:
+            df = select_songs(cur, df)
+        stage["rows"] = len(df)
+
+    songplay_cols = {"ts": "start_time",
+                     "userId": "user_id",
+                     "level": "level",
+                     "song_id": "song_id",
+                     "artist_id": "artist_id",
+                     "sessionId": "session_id",
+                     "location": "location",
+                     "userAgent": "user_agent",
+                     "source_file": "source_file",
+                     }
+    songplay_df = df[list(songplay_cols)].rename(columns=songplay_cols)
+
+    # Insert songplay records
+    with metrics.stage("insert") as stage:
+        stage["rows"] = len(songplay_df)
+        if bulk:
+            copy_df(cur, songplay_df, "songplays")
+        else:
+            for songplay in songplay_df.values.tolist():
+                cur.execute(sql.songplay_table_insert, songplay)
+
+
+def process_log_file(cur, filepath, bulk=False, lookup=None, chunksize=None):
+    """Process a given log file and load data to database.
+
+    If a chunksize is passed, the file is streamed: it is read, transformed
+    and flushed to the database in chunks of that many lines, so peak memory
+    does not depend on the file size.
+    """
+    if chunksize is None:
+        load_log_data(cur, *prepare_log_file(filepath), bulk=bulk, lookup=lookup)
+        return
+
+    reader = pd.read_json(filepath, lines=True, chunksize=chunksize)
+    try:
+        while True:
+            with metrics.stage("read") as stage:
+                df = next(reader, None)
+                stage["rows"] = 0 if df is None else len(df)
+            if df is None:
+                break
+            with metrics.stage("transform") as stage:
+                frames = transform_log_data(df, source_file=filepath)
+                stage["rows"] = len(frames[2])
+            load_log_data(cur, *frames, bulk=bulk, lookup=lookup)
+    finally:
+        reader.close()
+
+
+def process_data(cur, conn, filepath, func, manifest=None):
+    """Process each data file in a give filepath using the passed function.
+    If a FileManifest is passed, only new and changed files are processed
+    and recorded.
+    """
+    # Get all files matching extension from directory
+    all_files = get_new_files(cur, filepath, manifest)
 
     # Get total number of files found
     num_files = len(all_files)
     print(f"{num_files} files found in {filepath}.")
 
-    # Iterate over files and process
+    # Iterate over files and process, one transaction per file
     for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
-        # conn.commit()
+        with metrics.source(datafile):
+            func(cur, datafile)
+            if manifest is not None:
+                manifest.record(cur, datafile)
+            conn.commit()
         print(f"{i}/{num_files} files processed.")
 
 
+def parse_args():
+    """Parse the command line arguments of the ETL script."""
+    parser = argparse.ArgumentParser(
+        description="Load the sparkify song and log data into Postgres."
+    )
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="load each file with COPY and staging table merges "
+             "in one transaction instead of row by row inserts",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes reading the files and of database "
+             "connections loading them (default: 1, sequential)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="number of song files read and loaded together "
+             "(default: 1, one file at a time)",
+    )
+    parser.add_argument(
+        "--full-refresh",
+        action="store_true",
+        help="truncate all tables and the file manifest and reload all files "
+             "instead of only the new and changed ones",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=None,
+        help="stream log files in chunks of this many lines to bound memory "
+             "(sequential mode only, default: read whole files)",
+    )
+    parser.add_argument(
+        "--data-dir",
+        default="data",
+        help="directory containing song_data and log_data (default: data)",
+    )
+    parser.add_argument(
+        "--stats",
+        metavar="FILE",
+        help="count and time the database round trips per table and write "
+             "them to FILE as JSON",
+    )
+    parser.add_argument(
+        "--metrics-log",
+        metavar="FILE",
+        help="write wall time, rows and statements per file and stage "
+             "(read, transform, lookup, insert) to FILE as JSON lines",
+    )
+    parser.add_argument(
+        "--prometheus",
+        metavar="FILE",
+        help="write the metrics totals to FILE in Prometheus textfile format",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=5,
+        help="number of slowest files and statements in the summary "
+             "(default: 5)",
+    )
+    args = parser.parse_args()
+    if args.chunksize is not None and args.workers > 1:
+        parser.error("--chunksize can not be combined with --workers")
+    return args
+
+
+def run_parallel(cur, conn, args, lookup, manifest):
+    """Run the song and log phase with a pool of worker processes and a pool
+    of database connections.
+    """
+    song_path = os.path.join(args.data_dir, 'song_data')
+    log_path = os.path.join(args.data_dir, 'log_data')
+    pool = ConnectionPool(1, args.workers, db_params=config(),
+                          cursor_factory=CountingCursor)
+
+    song_files = get_new_files(cur, song_path, manifest)
+    conn.commit()
+    if args.batch_size > 1:
+        process_data_parallel(pool, split_batches(song_files, args.batch_size),
+                              prepare=prepare_song_batch,
+                              load=partial(load_song_data, bulk=args.bulk),
+                              workers=args.workers,
+                              record=manifest.record,
+                              unit="batches")
+    else:
+        process_data_parallel(pool, song_files,
+                              prepare=prepare_song_file,
+                              load=partial(load_song_data, bulk=args.bulk),
+                              workers=args.workers,
+                              record=manifest.record)
+    # All songs are committed now, so the lookup is complete
+    lookup.refresh(cur)
+
+    log_files = get_new_files(cur, log_path, manifest)
+    conn.commit()
+    process_data_parallel(pool, log_files,
+                          prepare=prepare_log_file,
+                          load=partial(load_log_data, bulk=args.bulk,
+                                       lookup=lookup),
+                          workers=args.workers,
+                          record=manifest.record)
+    pool.closeall()
+
+
+def run_sequential(cur, conn, args, lookup, manifest):
+    """Run the song and log phase file by file (or batch by batch)."""
+    song_path = os.path.join(args.data_dir, 'song_data')
+    log_path = os.path.join(args.data_dir, 'log_data')
+
+    if args.batch_size > 1:
+        process_song_batches(cur, conn, song_path, args.batch_size,
+                             bulk=args.bulk, lookup=lookup, manifest=manifest)
+    else:
+        process_data(cur, conn, filepath=song_path,
+                     func=partial(process_song_file, bulk=args.bulk,
+                                  lookup=lookup),
+                     manifest=manifest)
+    process_data(cur, conn, filepath=log_path,
+                 func=partial(process_log_file, bulk=args.bulk, lookup=lookup,
+                              chunksize=args.chunksize),
+                 manifest=manifest)
+
+
 def main():
-    conn, cur = get_connection()
+    args = parse_args()
+    # In bulk mode commit once per file instead of once per statement
+    # Statements are counted and timed for the metrics
+    cur, conn = connect(autocommit=not args.bulk, cursor_factory=CountingCursor)
+
+    if args.full_refresh:
+        print("Full refresh: truncating all tables.")
+        cur.execute(sql.truncate_tables)
+        conn.commit()
+
+    # Files loaded in earlier runs are skipped if unchanged
+    manifest = FileManifest.from_db(cur)
+    # Index the songs already in the database, new songs are added on load
+    lookup = SongLookup.from_db(cur)
+
+    if args.workers > 1:
+        run_parallel(cur, conn, args, lookup, manifest)
+    else:
+        run_sequential(cur, conn, args, lookup, manifest)
+    print(f"Song lookup: {len(lookup)} songs, "
+          f"{lookup.memory_usage() / 1024 ** 2:.1f} MB.")
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    close(cur, conn)
 
-    conn.close()
+    metrics.print_summary(args.top)
+    if args.stats:
+        with open(args.stats, "w") as f:
+            json.dump(query_stats.to_dict(), f, indent=2)
+    if args.metrics_log:
+        metrics.write_log(args.metrics_log)
+    if args.prometheus:
+        metrics.write_prometheus(args.prometheus)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,217 @@
+"""
+Generator for synthetic sparkify data. Song files and log events follow the
+formats described in the README. Song files are written one record per file
+to `song_data/<A>/<B>/<C>/<track_id>.json`, log events as newline delimited
+JSON to one file per day in `log_data/<year>/<month>/<date>-events.json`.
+
+    python generate_data.py data_synthetic --songs 10000 --events 1000000
+"""
+
+import argparse
+import json
+import os
+import random
+import string
+from datetime import datetime, timezone
+
+# Start of the simulated log period, in epoch milliseconds
+START_TS = int(datetime(2018, 11, 1, tzinfo=timezone.utc).timestamp() * 1000)
+DAY_MS = 86400000
+
+pages = ["NextSong"] * 8 + ["Home", "Logout"]
+user_agents = [
+    "\"Mozilla/5.0 (Windows NT 6.3; WOW64) AppleWebKit/537.36 (KHTML, like "
+    "Gecko) Chrome/36.0.1985.143 Safari/537.36\"",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.9; rv:31.0) Gecko/20100101 "
+    "Firefox/31.0",
+]
+locations = ["New Orleans-Metairie, LA",
+             "San Francisco-Oakland-Hayward, CA",
+             "Atlanta-Sandy Springs-Roswell, GA",
+             ]
+
+
+def _random_id(rnd, prefix):
+    return prefix + "".join(rnd.choices(string.ascii_uppercase + string.digits,
+                                        k=16))
+
+
+def generate_songs(num_songs, num_artists=None, seed=0):
+    """Generate song records in the format of the song files.
+
+    Every record gets an additional `track_id` used for the file name.
+    """
+    rnd = random.Random(seed)
+    num_artists = num_artists or max(1, num_songs // 4)
+    artists = [{"artist_id": _random_id(rnd, "AR"),
+                "artist_latitude": round(rnd.uniform(-90, 90), 5),
+                "artist_longitude": round(rnd.uniform(-180, 180), 5),
+                "artist_location": rnd.choice(locations),
+                "artist_name": f"Artist {i}",
+                }
+               for i in range(num_artists)
+               ]
+
+    songs = []
+    for i in range(num_songs):
+        song = {"num_songs": 1,
+                **rnd.choice(artists),
+                "song_id": _random_id(rnd, "SO"),
+                "title": f"Song {i}",
+                "duration": round(rnd.uniform(60, 600), 5),
+                "year": rnd.choice([0] + list(range(1960, 2019))),
+                "track_id": _random_id(rnd, "TR"),
+                }
+        songs.append(song)
+    return songs
+
+
+def generate_log_events(num_events, songs=None, num_users=100,
+                        events_per_day=2880, seed=0):
+    """Generate log events as dictionaries.
+
+    Parameters
+    ----------
+    num_events : int
+        Number of events to generate
+    songs : list, optional
+        (title, artist_name, duration) tuples the song plays are drawn from.
+        Defaults to a list of made up songs.
+    num_users : int
+        Number of distinct users
+    events_per_day : int
+        Average number of events per day, defines the time between events
+    seed : int
+        Seed of the random generator, same seed gives the same events
+    """
+    rnd = random.Random(seed)
+    if songs is None:
+        songs = [(f"Song {i}", f"Artist {i % 50}", round(rnd.uniform(60, 600), 5))
+                 for i in range(1000)
+                 ]
+    max_step = max(2, 2 * DAY_MS // events_per_day)
+
+    ts = START_TS
+    for i in range(num_events):
+        ts += rnd.randint(1, max_step)
+        user_id = rnd.randint(1, num_users)
+        page = rnd.choice(pages)
+        title, artist, duration = rnd.choice(songs)
+        yield {"artist": artist if page == "NextSong" else None,
+               "auth": "Logged In",
+               "firstName": f"First{user_id}",
+               "gender": "F" if user_id % 2 else "M",
+               "itemInSession": i % 100,
+               "lastName": f"Last{user_id}",
+               "length": duration if page == "NextSong" else None,
+               "level": rnd.choice(["free", "paid"]),
+               "location": locations[user_id % len(locations)],
+               "method": "PUT" if page == "NextSong" else "GET",
+               "page": page,
+               "registration": START_TS - user_id * DAY_MS,
+               "sessionId": user_id * 1000 + i // 1000,
+               "song": title if page == "NextSong" else None,
+               "status": 200,
+               "ts": ts,
+               "userAgent": user_agents[user_id % len(user_agents)],
+               "userId": str(user_id),
+               }
+
+
+def write_log_file(filepath, num_events, songs=None, num_users=100, seed=0):
+    """Write a log file with synthetic events."""
+    with open(filepath, "w", encoding="utf-8") as f:
+        for event in generate_log_events(num_events, songs, num_users,
+                                         seed=seed):
+            f.write(json.dumps(event) + "\n")
+
+
+def write_song_tree(root, songs):
+    """Write one song file per song record below `root/song_data`.
+    Return the number of files written.
+    """
+    for song in songs:
+        record = {k: v for k, v in song.items() if k != "track_id"}
+        track_id = song["track_id"]
+        song_dir = os.path.join(root, "song_data", *track_id[2:5])
+        os.makedirs(song_dir, exist_ok=True)
+        with open(os.path.join(song_dir, f"{track_id}.json"), "w",
+                  encoding="utf-8") as f:
+            f.write(json.dumps(record))
+    return len(songs)
+
+
+def write_log_tree(root, num_events, songs, num_users=100, events_per_day=2880,
+                   unknown_ratio=0.1, seed=0):
+    """Write log files with synthetic events below `root/log_data`, one file
+    per day. A share of `unknown_ratio` of the song plays refers to songs
+    which are not in the song files. Return the number of files written.
+    """
+    rnd = random.Random(seed)
+    song_keys = [(s["title"], s["artist_name"], s["duration"]) for s in songs]
+    num_unknown = int(len(song_keys) * unknown_ratio / (1 - unknown_ratio))
+    song_keys += [(f"Unknown {i}", "Unknown Artist",
+                   round(rnd.uniform(60, 600), 5))
+                  for i in range(num_unknown)
+                  ]
+
+    num_files, current_day, f = 0, None, None
+    try:
+        for event in generate_log_events(num_events, song_keys, num_users,
+                                         events_per_day, seed):
+            day = datetime.fromtimestamp(event["ts"] / 1000, tz=timezone.utc)
+            if day.date() != current_day:
+                if f is not None:
+                    f.close()
+                current_day = day.date()
+                log_dir = os.path.join(root, "log_data", f"{day:%Y}", f"{day:%m}")
+                os.makedirs(log_dir, exist_ok=True)
+                f = open(os.path.join(log_dir, f"{day:%Y-%m-%d}-events.json"),
+                         "w", encoding="utf-8")
+                num_files += 1
+            f.write(json.dumps(event) + "\n")
+    finally:
+        if f is not None:
+            f.close()
+    return num_files
+
+
+def generate_data(root, num_songs, num_events, num_users=100,
+                  events_per_day=2880, seed=0):
+    """Write a synthetic song_data and log_data tree below `root`.
+    Return the number of song and log files written.
+    """
+    songs = generate_songs(num_songs, seed=seed)
+    num_song_files = write_song_tree(root, songs)
+    num_log_files = write_log_tree(root, num_events, songs, num_users,
+                                   events_per_day, seed=seed)
+    return num_song_files, num_log_files
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic sparkify song and log data."
+    )
+    parser.add_argument("root", help="directory to write song_data and "
+                                     "log_data into")
+    parser.add_argument("--songs", type=int, default=10000,
+                        help="number of song files (default: 10000)")
+    parser.add_argument("--events", type=int, default=100000,
+                        help="number of log events (default: 100000)")
+    parser.add_argument("--users", type=int, default=100,
+                        help="number of distinct users (default: 100)")
+    parser.add_argument("--events-per-day", type=int, default=2880,
+                        help="events per daily log file (default: 2880)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    num_song_files, num_log_files = generate_data(
+        args.root, args.songs, args.events, args.users, args.events_per_day,
+        args.seed
+    )
+    print(f"{num_song_files} song files and {num_log_files} log files "
+          f"written to {args.root}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Ingestion manifest of the ETL pipeline. Every processed file is recorded in the
+`file_manifest` table with its size, modification time and content hash, so
+later runs only process files that are new or have changed since.
+"""
+
+import hashlib
+import os
+import sql_queries as sql
+
+
+def file_fingerprint(filepath):
+    """Return size, modification time and SHA-256 content hash of a file."""
+    stat = os.stat(filepath)
+    sha256 = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return stat.st_size, stat.st_mtime, sha256.hexdigest()
+
+
+class FileManifest:
+    """Processed files as recorded in the file_manifest table."""
+
+    def __init__(self, records=None):
+        # filepath -> (size, mtime, content_hash)
+        self.records = records or {}
+        # Fingerprints of the selected files, recorded once they are loaded
+        self.pending = {}
+
+    @classmethod
+    def from_db(cls, cur):
+        """Read the manifest from the database."""
+        cur.execute(sql.file_manifest_select)
+        return cls({filepath: (size, mtime, content_hash)
+                    for filepath, size, mtime, content_hash in cur.fetchall()
+                    })
+
+    def select_files(self, cur, all_files):
+        """Return the files that are new or have changed since they were
+        recorded.
+
+        Size and modification time are compared first, the content is only
+        hashed if one of them differs. Song plays loaded from changed files
+        are deleted together with their manifest entries, so the files can
+        be reloaded idempotently. Songs and artists of changed files are
+        updated by their upserts when the files are reloaded.
+        """
+        selected, changed = [], []
+        for filepath in all_files:
+            stat = os.stat(filepath)
+            recorded = self.records.get(filepath)
+            if recorded and recorded[:2] == (stat.st_size, stat.st_mtime):
+                continue
+
+            fingerprint = file_fingerprint(filepath)
+            if recorded and recorded[2] == fingerprint[2]:
+                # Touched, but same content
+                cur.execute(sql.file_manifest_upsert, (filepath, *fingerprint))
+                continue
+
+            if recorded:
+                changed.append(filepath)
+            self.pending[filepath] = fingerprint
+            selected.append(filepath)
+
+        if changed:
+            cur.execute(sql.songplay_source_file_delete, (changed,))
+            cur.execute(sql.file_manifest_delete, (changed,))
+            for filepath in changed:
+                del self.records[filepath]
+
+        return selected
+
+    def record(self, cur, filepaths):
+        """Record one or more loaded files in the manifest. Should be called
+        in the transaction that loaded the files.
+        """
+        if isinstance(filepaths, str):
+            filepaths = [filepaths]
+        for filepath in filepaths:
+            fingerprint = self.pending.pop(filepath, None) \
+                or file_fingerprint(filepath)
+            cur.execute(sql.file_manifest_upsert, (filepath, *fingerprint))
+            self.records[filepath] = fingerprint
@@ -0,0 +1,161 @@
+"""
+Per-stage instrumentation of the ETL pipeline. Every file (or batch of files)
+passes the stages read, transform, lookup and insert. For each stage the wall
+time, the number of rows and the number of SQL statements issued are recorded
+in `metrics`. The records can be written to a metrics log (JSON lines) or to
+a Prometheus textfile, and summarized at the end of a run.
+"""
+
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from query_stats import query_stats
+
+stage_names = ["read", "transform", "lookup", "insert"]
+
+
+def source_label(item):
+    """Return the source name of a file or of a batch (list) of files."""
+    if isinstance(item, str):
+        return item
+    return f"{item[0]} (+{len(item) - 1} files)"
+
+
+class StageMetrics:
+    """Thread-safe collection of stage records.
+
+    The source of the records, i.e. the file or batch being processed, is set
+    per thread with `source()`, the stages are timed with `stage()`:
+
+        with metrics.source(filepath):
+            with metrics.stage("read") as stage:
+                df = pd.read_json(filepath, lines=True)
+                stage["rows"] = len(df)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.records = []
+
+    @contextmanager
+    def source(self, name):
+        """Attribute the stages of the with block to a file or batch."""
+        previous = getattr(self._local, "source", None)
+        self._local.source = name
+        try:
+            yield
+        finally:
+            self._local.source = previous
+
+    @contextmanager
+    def stage(self, name):
+        """Time a stage. Yields the record, so the rows can be set."""
+        record = {"source": getattr(self._local, "source", None),
+                  "stage": name,
+                  "rows": 0,
+                  }
+        round_trips = query_stats.thread_round_trips()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            record["statements"] = query_stats.thread_round_trips() - round_trips
+            with self._lock:
+                self.records.append(record)
+
+    def drain(self):
+        """Remove and return all records, e.g. to send them from a worker
+        process to the main process.
+        """
+        with self._lock:
+            records, self.records = self.records, []
+        return records
+
+    def extend(self, records):
+        """Add records collected elsewhere, e.g. in a worker process."""
+        with self._lock:
+            self.records.extend(records)
+
+    def totals(self):
+        """Return seconds, rows and statements summed up per stage."""
+        totals = defaultdict(lambda: {"seconds": 0.0, "rows": 0, "statements": 0})
+        with self._lock:
+            for record in self.records:
+                for key in ["seconds", "rows", "statements"]:
+                    totals[record["stage"]][key] += record[key]
+        return dict(totals)
+
+    def slowest_sources(self, top_n=5):
+        """Return (source, seconds) of the files with the highest total time."""
+        seconds = defaultdict(float)
+        with self._lock:
+            for record in self.records:
+                seconds[record["source"]] += record["seconds"]
+        return sorted(seconds.items(), key=lambda s: s[1], reverse=True)[:top_n]
+
+    def write_log(self, filepath):
+        """Write all records to a metrics log, one JSON object per line."""
+        with self._lock:
+            records = list(self.records)
+        with open(filepath, "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+
+    def write_prometheus(self, filepath):
+        """Write the totals per stage and per table in the Prometheus textfile
+        format, e.g. for the node exporter textfile collector.
+        """
+        lines = []
+        stage_metrics = [("etl_stage_seconds_total", "seconds",
+                          "Wall time per stage"),
+                         ("etl_stage_rows_total", "rows",
+                          "Rows processed per stage"),
+                         ("etl_stage_statements_total", "statements",
+                          "SQL statements issued per stage"),
+                         ]
+        totals = self.totals()
+        for metric, key, description in stage_metrics:
+            lines += [f"# HELP {metric} {description}.",
+                      f"# TYPE {metric} counter"]
+            for stage, values in totals.items():
+                lines.append(f'{metric}{{stage="{stage}"}} {values[key]}')
+
+        stats = query_stats.to_dict()
+        for metric, key, description in [
+                ("etl_table_round_trips_total", "round_trips_per_table",
+                 "Database round trips per table"),
+                ("etl_table_seconds_total", "seconds_per_table",
+                 "Database time per table")]:
+            lines += [f"# HELP {metric} {description}.",
+                      f"# TYPE {metric} counter"]
+            for table, value in stats[key].items():
+                lines.append(f'{metric}{{table="{table}"}} {value}')
+
+        with open(filepath, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def print_summary(self, top_n=5):
+        """Print the totals per stage and the slowest files and statements."""
+        print("Time per stage:")
+        totals = self.totals()
+        for stage in stage_names + sorted(set(totals) - set(stage_names)):
+            if stage in totals:
+                values = totals[stage]
+                print(f"  {stage:<10} {values['seconds']:>9.2f} s "
+                      f"{values['rows']:>10} rows "
+                      f"{values['statements']:>9} statements")
+
+        print(f"Slowest {top_n} files:")
+        for source, seconds in self.slowest_sources(top_n):
+            print(f"  {seconds:>9.2f} s  {source}")
+
+        print(f"Slowest {top_n} statements (total time):")
+        for text, count, total, longest in query_stats.slowest_statements(top_n):
+            print(f"  {total:>9.2f} s  {count:>8}x  max {longest:.3f} s  {text}")
+
+
+metrics = StageMetrics()
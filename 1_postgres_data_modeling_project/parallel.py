@@ -0,0 +1,87 @@
+"""
+Parallel ingestion mode of the ETL pipeline. The JSON files are read and
+transformed in a pool of worker processes, the resulting DataFrames are loaded
+by a pool of threads, each using its own connection from a connection pool.
+Progress is reported in file order.
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from metrics import metrics, source_label
+
+# Number of files sent to a worker process at once. Song files hold a single
+# record, so this saves most of the per-file inter-process overhead.
+MAX_CHUNKSIZE = 64
+
+
+def prepare_with_metrics(prepare, item):
+    """Run `prepare` on an item in a worker process. Return the frames and
+    the stage records, which are collected in the worker process otherwise.
+    """
+    with metrics.source(source_label(item)):
+        frames = prepare(item)
+    return frames, metrics.drain()
+
+
+def load_with_pool(pool, load, frames, record=None, item=None):
+    """Load the transformed frames of one item in its own transaction, using
+    a connection from the pool. If passed, `record(cur, item)` is called in
+    the same transaction.
+    """
+    with metrics.source(source_label(item)), pool.transaction() as cur:
+        load(cur, *frames)
+        if record is not None:
+            record(cur, item)
+
+
+def process_data_parallel(pool, all_files, prepare, load, workers,
+                          record=None, unit="files"):
+    """Prepare and load the passed files (or batches of files) in parallel.
+
+    Parameters
+    ----------
+    pool : db_connect.ConnectionPool
+        Pool with at least `workers` connections
+    all_files : list
+        Paths of the files to process, or lists of paths for batches
+    prepare : function
+        Module level function reading and transforming a single item of
+        `all_files`, executed in the worker processes. Returns a tuple of
+        DataFrames.
+    load : function
+        Function loading the DataFrames returned by `prepare`, called with
+        a cursor as first argument.
+    workers : int
+        Number of worker processes and of loader threads
+    record : function, optional
+        Called with a cursor and the item after each load, in the same
+        transaction, e.g. to record the loaded files in the manifest.
+    unit : string
+        Name of the items for progress reporting
+    """
+    num_files = len(all_files)
+    print(f"{num_files} {unit} found.")
+    chunksize = max(1, min(MAX_CHUNKSIZE, num_files // (workers * 4)))
+
+    with ProcessPoolExecutor(workers) as processes, \
+            ThreadPoolExecutor(workers) as threads:
+        # Loads are reported in file order. Waiting for the oldest load once
+        # too many are pending keeps the transformed frames in memory bounded.
+        pending = deque()
+        processed = 0
+        results = processes.map(partial(prepare_with_metrics, prepare),
+                                all_files, chunksize=chunksize)
+        for item, (frames, records) in zip(all_files, results):
+            metrics.extend(records)
+            pending.append(threads.submit(load_with_pool, pool, load, frames,
+                                          record, item))
+            while pending and (pending[0].done() or len(pending) > 4 * workers):
+                pending.popleft().result()
+                processed += 1
+                print(f"{processed}/{num_files} {unit} processed.")
+
+        while pending:
+            pending.popleft().result()
+            processed += 1
+            print(f"{processed}/{num_files} {unit} processed.")
@@ -0,0 +1,114 @@
+"""
+Statement statistics of the ETL pipeline. `CountingCursor` is a psycopg2
+cursor that counts every round trip to the database (execute, executemany and
+COPY) and times it per target table and per statement. The counts of all
+cursors, including the ones of pool connections in other threads, are
+collected in `query_stats`.
+"""
+
+import re
+import threading
+import time
+from collections import defaultdict
+import psycopg2.extensions
+
+# Target table of a statement, staging tables are attributed to their table
+table_pattern = re.compile(
+    r"^\s*(?:INSERT\s+INTO|COPY|TRUNCATE|DELETE\s+FROM|UPDATE|"
+    r"CREATE\s+TEMP\s+TABLE\s+IF\s+NOT\s+EXISTS)\s+(?:stage_)?(\w+)",
+    re.IGNORECASE
+)
+
+
+def statement_table(query):
+    """Return the target table of a statement, or 'select' for queries."""
+    match = table_pattern.match(query)
+    return match.group(1).lower() if match else "select"
+
+
+def statement_text(query, max_length=100):
+    """Return a statement with collapsed whitespace, shortened if needed."""
+    text = " ".join(query.split())
+    return text if len(text) <= max_length else text[:max_length - 3] + "..."
+
+
+class QueryStats:
+    """Thread-safe round trip counts and times per target table."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.round_trips = defaultdict(int)
+            self.seconds = defaultdict(float)
+            # statement text -> [count, total seconds, max seconds]
+            self.statements = defaultdict(lambda: [0, 0.0, 0.0])
+
+    def add(self, query, seconds):
+        if isinstance(query, bytes):
+            query = query.decode()
+        table = statement_table(query)
+        text = statement_text(query)
+        self._local.round_trips = self.thread_round_trips() + 1
+        with self._lock:
+            self.round_trips[table] += 1
+            self.seconds[table] += seconds
+            statement = self.statements[text]
+            statement[0] += 1
+            statement[1] += seconds
+            statement[2] = max(statement[2], seconds)
+
+    def thread_round_trips(self):
+        """Return the number of round trips issued by the current thread."""
+        return getattr(self._local, "round_trips", 0)
+
+    def slowest_statements(self, top_n=5):
+        """Return (statement, count, total seconds, max seconds) tuples of
+        the statements with the highest total time.
+        """
+        with self._lock:
+            statements = [(text, *stats)
+                          for text, stats in self.statements.items()]
+        return sorted(statements, key=lambda s: s[2], reverse=True)[:top_n]
+
+    def to_dict(self):
+        with self._lock:
+            return {"round_trips": sum(self.round_trips.values()),
+                    "round_trips_per_table": dict(self.round_trips),
+                    "seconds_per_table": dict(self.seconds),
+                    }
+
+
+query_stats = QueryStats()
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Cursor recording each round trip in `query_stats`."""
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            query_stats.add(query, time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        # One round trip per parameter set
+        vars_list = list(vars_list)
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            elapsed = time.perf_counter() - start
+            for vars in vars_list:
+                query_stats.add(query, elapsed / len(vars_list))
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            query_stats.add(sql, time.perf_counter() - start)
@@ -0,0 +1,112 @@
+"""
+In-memory lookup index for resolving the song_id and artist_id of song plays.
+Instead of running `song_select` once per log event, the index is built once
+from the songs and artists tables (and/or the song files as they are loaded)
+and a whole log DataFrame is resolved with a single merge.
+
+Songs added with `update` are buffered and merged into the index once, when
+it is next read, so adding the song files one by one stays linear.
+"""
+
+import pandas as pd
+import sql_queries as sql
+from db_connect import named_cursor
+
+# Durations are given with 5 decimals in the song files. Rounding both sides
+# makes the float key robust against DECIMAL -> float conversion noise.
+DURATION_DECIMALS = 5
+
+
+class SongLookup:
+    """Index of (song_id, artist_id) keyed on (title, artist_name, duration)."""
+
+    key_cols = ["title", "artist_name", "duration"]
+    value_cols = ["song_id", "artist_id"]
+
+    def __init__(self):
+        self.index = pd.DataFrame(
+            {col: pd.Series(dtype=float if col == "duration" else object)
+             for col in self.key_cols + self.value_cols}
+        )
+        self._pending = []
+
+    def __len__(self):
+        self._merge_pending()
+        return len(self.index)
+
+    @classmethod
+    def from_db(cls, cur):
+        """Build the index from the songs and artists tables."""
+        lookup = cls()
+        lookup.refresh(cur)
+        return lookup
+
+    def refresh(self, cur):
+        """Add all songs from the songs and artists tables to the index.
+
+        The songs are streamed in batches from a server-side cursor on the
+        connection of the passed cursor.
+        """
+        frames = []
+        with named_cursor(cur.connection, "song_lookup") as song_cur:
+            song_cur.execute(sql.song_lookup_select)
+            while True:
+                rows = song_cur.fetchmany(song_cur.itersize)
+                if not rows:
+                    break
+                frames.append(pd.DataFrame(
+                    rows, columns=self.key_cols + self.value_cols
+                ))
+        if frames:
+            self.update(pd.concat(frames, ignore_index=True))
+
+    def update(self, df):
+        """Add new songs to the index.
+
+        Parameters
+        ----------
+        df : DataFrame
+            Containing the columns title, artist_name, duration, song_id and
+            artist_id, e.g. the raw content of song files.
+        """
+        records = df[self.key_cols + self.value_cols].copy()
+        records["duration"] = self._normalize_duration(records["duration"])
+        self._pending.append(records)
+
+    def _merge_pending(self):
+        """Merge the buffered songs into the index, keeping the first entry
+        per key.
+        """
+        if not self._pending:
+            return
+        self.index = (pd.concat([self.index] + self._pending, ignore_index=True)
+                      .drop_duplicates(self.key_cols, keep="first")
+                      .reset_index(drop=True)
+                      )
+        self._pending = []
+
+    def resolve(self, df):
+        """Return a copy of a log DataFrame with song_id and artist_id columns.
+
+        Events without a matching song get missing values for both ids.
+        """
+        self._merge_pending()
+        keys = pd.DataFrame({"title": df["song"].values,
+                             "artist_name": df["artist"].values,
+                             "duration": self._normalize_duration(df["length"]).values,
+                             })
+        matches = keys.merge(self.index, on=self.key_cols, how="left")
+
+        df = df.copy()
+        for col in self.value_cols:
+            df[col] = matches[col].where(matches[col].notna(), None).values
+        return df
+
+    def memory_usage(self):
+        """Return the memory footprint of the index in bytes."""
+        self._merge_pending()
+        return int(self.index.memory_usage(deep=True).sum())
+
+    @staticmethod
+    def _normalize_duration(durations):
+        return pd.to_numeric(durations).astype(float).round(DURATION_DECIMALS)
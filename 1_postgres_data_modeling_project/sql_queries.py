@@ -5,6 +5,7 @@ user_table_drop = "DROP TABLE IF EXISTS users;"
 song_table_drop = "DROP TABLE IF EXISTS songs;"
 artist_table_drop = "DROP TABLE IF EXISTS artists;"
 time_table_drop = "DROP TABLE IF EXISTS time;"
+file_manifest_drop = "DROP TABLE IF EXISTS file_manifest;"
 
 # CREATE TABLES
 
@@ -17,10 +18,15 @@ songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays
                                            artist_id VARCHAR(18),
                                            session_id INT NOT NULL,
                                            location VARCHAR NOT NULL,
-                                           user_agent VARCHAR NOT NULL
+                                           user_agent VARCHAR NOT NULL,
+                                           source_file VARCHAR
                                            );
 """)
 
+songplay_source_file_index_create = ("""CREATE INDEX IF NOT EXISTS songplays_source_file_idx
+                                            ON songplays (source_file);
+""")
+
 user_table_create = ("""CREATE TABLE IF NOT EXISTS users
                                    (user_id INT PRIMARY KEY,
                                     first_name VARCHAR NOT NULL,
@@ -49,7 +55,7 @@ artist_table_create = ("""CREATE TABLE IF NOT EXISTS artists
 """)
 
 time_table_create = ("""CREATE TABLE IF NOT EXISTS time
-                                   (start_time TIMESTAMP NOT NULL,
+                                   (start_time TIMESTAMP PRIMARY KEY,
                                     hour INT NOT NULL,
                                     day INT NOT NULL,
                                     week INT NOT NULL,
@@ -59,6 +65,15 @@ time_table_create = ("""CREATE TABLE IF NOT EXISTS time
                                     );
 """)
 
+file_manifest_create = ("""CREATE TABLE IF NOT EXISTS file_manifest
+                                   (filepath VARCHAR PRIMARY KEY,
+                                    size BIGINT NOT NULL,
+                                    mtime DOUBLE PRECISION NOT NULL,
+                                    content_hash CHAR(64) NOT NULL,
+                                    processed_at TIMESTAMP NOT NULL DEFAULT now()
+                                    );
+""")
+
 # INSERT RECORDS
 
 songplay_table_insert = ("""INSERT INTO songplays
@@ -69,8 +84,9 @@ songplay_table_insert = ("""INSERT INTO songplays
                                  artist_id,
                                  session_id,
                                  location,
-                                 user_agent)
-                             VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
+                                 user_agent,
+                                 source_file)
+                             VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);
 """)
 
 user_table_insert = ("""INSERT INTO users
@@ -91,7 +107,11 @@ song_table_insert = ("""INSERT INTO songs
                              year,
                              duration)
                         VALUES (%s, %s, %s, %s, %s)
-                        ON CONFLICT DO NOTHING;
+                        ON CONFLICT (song_id) DO UPDATE
+                        SET title = EXCLUDED.title,
+                            artist_id = EXCLUDED.artist_id,
+                            year = EXCLUDED.year,
+                            duration = EXCLUDED.duration;
 """)
 
 artist_table_insert = ("""INSERT INTO artists
@@ -101,7 +121,11 @@ artist_table_insert = ("""INSERT INTO artists
                              latitude,
                              longitude)
                         VALUES (%s, %s, %s, %s, %s)
-                        ON CONFLICT DO NOTHING;
+                        ON CONFLICT (artist_id) DO UPDATE
+                        SET name = EXCLUDED.name,
+                            location = EXCLUDED.location,
+                            latitude = EXCLUDED.latitude,
+                            longitude = EXCLUDED.longitude;
 """)
 
 time_table_insert = ("""INSERT INTO time
@@ -113,7 +137,127 @@ time_table_insert = ("""INSERT INTO time
                              year,
                              weekday)
                         VALUES (%s, %s, %s, %s, %s, %s, %s)
-                        ON CONFLICT DO NOTHING;
+                        ON CONFLICT (start_time) DO NOTHING;
+""")
+
+# BULK LOAD (COPY FROM STDIN + MERGE FROM STAGING)
+
+copy_from_stdin = ("""COPY {table} ({columns})
+                      FROM STDIN
+                      WITH (FORMAT csv, NULL '\\N');
+""")
+
+staging_table_create = ("""CREATE TEMP TABLE IF NOT EXISTS {staging}
+                               (LIKE {table} INCLUDING DEFAULTS);
+""")
+
+staging_table_truncate = "TRUNCATE {staging};"
+
+user_table_merge = ("""INSERT INTO users
+                           (user_id,
+                            first_name,
+                            last_name,
+                            gender,
+                            level)
+                       SELECT DISTINCT ON (user_id)
+                              user_id,
+                              first_name,
+                              last_name,
+                              gender,
+                              level
+                       FROM   stage_users
+                       ON CONFLICT (user_id) DO UPDATE
+                       SET level = EXCLUDED.level;
+""")
+
+song_table_merge = ("""INSERT INTO songs
+                           (song_id,
+                            title,
+                            artist_id,
+                            year,
+                            duration)
+                       SELECT DISTINCT ON (song_id)
+                              song_id,
+                              title,
+                              artist_id,
+                              year,
+                              duration
+                       FROM   stage_songs
+                       ON CONFLICT (song_id) DO UPDATE
+                       SET title = EXCLUDED.title,
+                           artist_id = EXCLUDED.artist_id,
+                           year = EXCLUDED.year,
+                           duration = EXCLUDED.duration;
+""")
+
+artist_table_merge = ("""INSERT INTO artists
+                             (artist_id,
+                              name,
+                              location,
+                              latitude,
+                              longitude)
+                         SELECT DISTINCT ON (artist_id)
+                                artist_id,
+                                name,
+                                location,
+                                latitude,
+                                longitude
+                         FROM   stage_artists
+                         ON CONFLICT (artist_id) DO UPDATE
+                         SET name = EXCLUDED.name,
+                             location = EXCLUDED.location,
+                             latitude = EXCLUDED.latitude,
+                             longitude = EXCLUDED.longitude;
+""")
+
+time_table_merge = ("""INSERT INTO time
+                           (start_time,
+                            hour,
+                            day,
+                            week,
+                            month,
+                            year,
+                            weekday)
+                       SELECT DISTINCT
+                              start_time,
+                              hour,
+                              day,
+                              week,
+                              month,
+                              year,
+                              weekday
+                       FROM   stage_time
+                       ON CONFLICT (start_time) DO NOTHING;
+""")
+
+# INGESTION MANIFEST
+
+file_manifest_select = ("""SELECT filepath,
+                                  size,
+                                  mtime,
+                                  content_hash
+                           FROM   file_manifest;
+""")
+
+file_manifest_upsert = ("""INSERT INTO file_manifest
+                               (filepath,
+                                size,
+                                mtime,
+                                content_hash)
+                           VALUES (%s, %s, %s, %s)
+                           ON CONFLICT (filepath) DO UPDATE
+                           SET size = EXCLUDED.size,
+                               mtime = EXCLUDED.mtime,
+                               content_hash = EXCLUDED.content_hash,
+                               processed_at = now();
+""")
+
+file_manifest_delete = "DELETE FROM file_manifest WHERE filepath = ANY(%s);"
+
+songplay_source_file_delete = "DELETE FROM songplays WHERE source_file = ANY(%s);"
+
+truncate_tables = ("""TRUNCATE songplays, users, songs, artists, time, file_manifest
+                      RESTART IDENTITY;
 """)
 
 # FIND SONGS
@@ -128,17 +272,30 @@ song_select = ("""SELECT s.song_id,
                     AND  s.duration = %s;
 """)
 
+song_lookup_select = ("""SELECT s.title,
+                                a.name AS artist_name,
+                                s.duration,
+                                s.song_id,
+                                s.artist_id
+                         FROM   songs AS s
+                         JOIN   artists AS a
+                           ON   a.artist_id = s.artist_id;
+""")
+
 # QUERY LISTS
 
 create_table_queries = [songplay_table_create,
+                        songplay_source_file_index_create,
                         user_table_create,
                         song_table_create,
                         artist_table_create,
                         time_table_create,
+                        file_manifest_create,
                         ]
 drop_table_queries = [songplay_table_drop,
                       user_table_drop,
                       song_table_drop,
                       artist_table_drop,
                       time_table_drop,
+                      file_manifest_drop,
                       ]
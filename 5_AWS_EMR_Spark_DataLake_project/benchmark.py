@@ -0,0 +1,373 @@
+"""
+Benchmarks of the Spark ETL on a local-mode Spark session and synthetic data.
+Executor CPU time and shuffle bytes are read from the Spark monitoring REST
+API (see spark_metrics.py), results are saved as JSON.
+
+    python benchmark.py timestamp --rows 10000000
+    python benchmark.py dedup --rows 10000000 --users 100000
+    python benchmark.py pushdown --rows 10000000
+
+timestamp
+    The log transform path (start_time and the time table columns) with the
+    former Python UDF, an Arrow-backed pandas UDF and the native column
+    expression used in etl.py.
+dedup
+    Users table deduplication with drop_duplicates (former etl.py) and with
+    the latest-wins window of dedup_latest, on randomly partitioned events
+    and on events already partitioned by user. Every variant runs on two
+    different row orders, the checksums show if the result is deterministic.
+pushdown
+    Point queries by user_id and song_id on synthetic songplays, written
+    partitioned only (former etl.py) and with the layout of etl.py (sorted,
+    bloom filters, small row groups). Reports the bytes and records read,
+    i.e. how much the parquet filter pushdown skipped, and the share of
+    files the table metadata file prunes.
+"""
+
+import argparse
+import json
+import random
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from pyspark.sql import SparkSession
+from pyspark.sql import functions as F
+from pyspark.sql.types import TimestampType
+from etl import (add_start_time,
+                 dedup_latest,
+                 write_table,
+                 parquet_options,
+                 SONGPLAYS_SORT_BY,
+                 SONGPLAYS_BLOOM_FILTER_COLUMNS,
+                 SONGPLAYS_ROW_GROUP_MB,
+                 )
+from spark_metrics import job_group, group_stages, summarize_stages
+from table_metadata import write_table_metadata, files_matching
+
+# 2018-11-01 00:00:00 UTC in epoch milliseconds, like the Sparkify log data
+START_TS = 1541030400000
+
+
+def create_local_session(cores):
+    """Create a local-mode Spark session with the UI (and REST API) enabled."""
+    return SparkSession \
+        .builder \
+        .master(f"local[{cores}]") \
+        .appName("sparkify-benchmark") \
+        .config("spark.sql.session.timeZone", "UTC") \
+        .config("spark.ui.enabled", "true") \
+        .getOrCreate()
+
+
+def generate_events(spark, rows, partitions):
+    """Return a cached DataFrame of `rows` synthetic events with epoch
+    millisecond timestamps spread over about one month.
+    """
+    df = (spark.range(0, rows, numPartitions=partitions)
+          .select(event_ts(rows).alias("ts"),
+                  (F.col("id") % 100).cast("string").alias("userId"),
+                  F.lit("NextSong").alias("page"),
+                  )
+          ).cache()
+    df.count()
+    return df
+
+
+def event_ts(rows):
+    """Timestamps of the generated events, evenly spread over 30 days."""
+    step = max(1, 30 * 24 * 3600 * 1000 // rows)
+    return F.lit(START_TS) + F.col("id") * step
+
+
+def add_start_time_udf(df):
+    """Former implementation of etl.py: a row-at-a-time Python UDF."""
+    get_datetime = F.udf(lambda x: datetime.utcfromtimestamp(x / 1000),
+                         TimestampType()
+                         )
+    return df.withColumn("start_time", get_datetime("ts"))
+
+
+def add_start_time_pandas_udf(df):
+    """Vectorized variant: an Arrow-backed pandas UDF."""
+    import pandas as pd
+
+    @F.pandas_udf(TimestampType(), F.PandasUDFType.SCALAR)
+    def to_datetime(ts):
+        return pd.to_datetime(ts, unit="ms")
+
+    return df.withColumn("start_time", to_datetime("ts"))
+
+
+timestamp_variants = {
+    "udf": add_start_time_udf,
+    "pandas_udf": add_start_time_pandas_udf,
+    "native": add_start_time,
+}
+
+
+def time_table_aggregate(df):
+    """Derive the time table columns and aggregate them, so every column
+    has to be computed for every row.
+    """
+    return df.agg(F.count("start_time").alias("rows"),
+                  F.max("start_time").alias("max_start_time"),
+                  F.sum(F.hour("start_time")).alias("hours"),
+                  F.sum(F.dayofmonth("start_time")).alias("days"),
+                  F.sum(F.weekofyear("start_time")).alias("weeks"),
+                  F.sum(F.dayofweek("start_time")).alias("weekdays"),
+                  )
+
+
+def run_measured(spark, name, action):
+    """Run an action in a job group and return wall time and stage totals."""
+    start = time.perf_counter()
+    with job_group(spark, name):
+        result = action()
+    wall_time = time.perf_counter() - start
+    totals = summarize_stages(group_stages(spark, name))
+    return result, wall_time, totals
+
+
+def bench_timestamp(spark, args):
+    """Compare the start_time conversions of `timestamp_variants`."""
+    events = generate_events(spark, args.rows, args.partitions)
+    runs = []
+    for variant in args.variants:
+        add = timestamp_variants[variant]
+        for i in range(args.repeat):
+            name = f"timestamp-{variant}-{i}"
+            result, wall_time, totals = run_measured(
+                spark, name,
+                lambda: time_table_aggregate(add(events)).collect()[0]
+            )
+            run = {"variant": variant,
+                   "repeat": i,
+                   "wall_time_s": wall_time,
+                   "rows_per_sec": args.rows / wall_time,
+                   "executor_cpu_s": totals["executorCpuTime"] / 1e9,
+                   "executor_run_s": totals["executorRunTime"] / 1e3,
+                   "max_start_time": str(result["max_start_time"]),
+                   "hours": result["hours"],
+                   }
+            print(f"  {variant:<11} {wall_time:>7.2f} s, "
+                  f"{run['rows_per_sec']:>12.0f} rows/s, "
+                  f"executor CPU {run['executor_cpu_s']:.2f} s")
+            runs.append(run)
+    events.unpersist()
+    return runs
+
+
+def users_table_drop_duplicates(events):
+    """Former implementation of etl.py, keeps an arbitrary row per user."""
+    return events.select("userId", "level").drop_duplicates(["userId"])
+
+
+def users_table_latest(events):
+    """Latest-wins deduplication of etl.py."""
+    return dedup_latest(events.select("userId", "level", "ts"),
+                        ["userId"], ["ts"]).drop("ts")
+
+
+dedup_variants = {
+    "drop_duplicates": (users_table_drop_duplicates, False),
+    "window": (users_table_latest, False),
+    "window_prepartitioned": (users_table_latest, True),
+}
+
+
+def bench_dedup(spark, args):
+    """Compare the users table deduplications of `dedup_variants`."""
+    events = (generate_events(spark, args.rows, args.partitions)
+              .withColumn("userId", (F.col("ts") % args.users).cast("string"))
+              .withColumn("level", F.when(F.hash("ts") % 3 == 0, "paid")
+                          .otherwise("free"))
+              )
+    # Two row orders of the same events
+    orders = [events.repartition(args.partitions, F.rand(seed))
+              for seed in [1, 2]]
+    prepartitioned = [df.repartition(args.partitions, "userId") for df in orders]
+    for df in orders + prepartitioned:
+        df.cache().count()
+
+    runs = []
+    for variant in args.variants:
+        dedup, use_prepartitioned = dedup_variants[variant]
+        inputs = prepartitioned if use_prepartitioned else orders
+        for i, df in enumerate(inputs):
+            name = f"dedup-{variant}-{i}"
+            result, wall_time, totals = run_measured(
+                spark, name,
+                lambda: dedup(df).agg(
+                    F.count("*").alias("rows"),
+                    F.sum(F.hash("userId", "level")).alias("checksum")
+                ).collect()[0]
+            )
+            run = {"variant": variant,
+                   "row_order": i,
+                   "wall_time_s": wall_time,
+                   "rows_per_sec": args.rows / wall_time,
+                   "shuffle_write_mb": totals["shuffleWriteBytes"] / 1024 ** 2,
+                   "executor_cpu_s": totals["executorCpuTime"] / 1e9,
+                   "users": result["rows"],
+                   "checksum": result["checksum"],
+                   }
+            print(f"  {variant:<22} order {i} {wall_time:>7.2f} s, "
+                  f"shuffle {run['shuffle_write_mb']:>8.1f} MB, "
+                  f"checksum {run['checksum']}")
+            runs.append(run)
+    for df in orders + prepartitioned:
+        df.unpersist()
+    return runs
+
+
+def generate_songplays(spark, rows, users, songs, partitions):
+    """Return synthetic songplays over about one month."""
+    events = add_start_time(generate_events(spark, rows, partitions))
+    return events.select(
+        "start_time",
+        (F.abs(F.hash("ts")) % users).cast("string").alias("user_id"),
+        F.format_string("SO%06d",
+                        F.abs(F.hash("ts", F.lit(1))) % songs).alias("song_id"),
+        F.month("start_time").alias("month"),
+        F.year("start_time").alias("year"),
+    )
+
+
+def bench_pushdown(spark, args):
+    """Compare point queries on the songplays layouts."""
+    songplays = generate_songplays(spark, args.rows, args.users, args.songs,
+                                   args.partitions)
+    tmp_dir = tempfile.mkdtemp()
+    layouts = {"partitioned": f"{tmp_dir}/partitioned",
+               "sorted_bloom": f"{tmp_dir}/sorted_bloom",
+               }
+    songplays.write.parquet(layouts["partitioned"], mode="overwrite",
+                            partitionBy=["year", "month"])
+    write_table(spark, songplays, layouts["sorted_bloom"],
+                partition_by=["year", "month"],
+                sort_by=SONGPLAYS_SORT_BY,
+                options=parquet_options(SONGPLAYS_BLOOM_FILTER_COLUMNS,
+                                        SONGPLAYS_ROW_GROUP_MB))
+    metadata = write_table_metadata(spark, layouts["sorted_bloom"],
+                                    ["user_id", "song_id"])
+
+    rng = random.Random(0)
+    queries = ([("user_id", str(rng.randrange(args.users)))
+                for _ in range(args.queries)]
+               + [("song_id", f"SO{rng.randrange(args.songs):06d}")
+                  for _ in range(args.queries)])
+    runs = []
+    try:
+        for layout, path in layouts.items():
+            for i, (column, value) in enumerate(queries):
+                name = f"pushdown-{layout}-{i}"
+                result, wall_time, totals = run_measured(
+                    spark, name,
+                    lambda: spark.read.parquet(path)
+                    .where(F.col(column) == value).count()
+                )
+                run = {"layout": layout,
+                       "column": column,
+                       "value": value,
+                       "rows": result,
+                       "wall_time_s": wall_time,
+                       "input_mb": totals["inputBytes"] / 1024 ** 2,
+                       "input_records": totals["inputRecords"],
+                       }
+                if layout == "sorted_bloom":
+                    run["metadata_files"] = len(files_matching(metadata, column,
+                                                               value))
+                    run["total_files"] = len(metadata["files"])
+                runs.append(run)
+
+            for column in ["user_id", "song_id"]:
+                column_runs = [r for r in runs
+                               if r["layout"] == layout and r["column"] == column]
+                records = sum(r["input_records"] for r in column_runs)
+                print(f"  {layout:<13} by {column:<8} "
+                      f"{sum(r['wall_time_s'] for r in column_runs):>7.2f} s, "
+                      f"{sum(r['input_mb'] for r in column_runs):>8.1f} MB read, "
+                      f"{records / (args.rows * len(column_runs)):>6.1%} "
+                      "of the rows read")
+        matched = [r["metadata_files"] / r["total_files"] for r in runs
+                   if "metadata_files" in r]
+        print(f"  metadata file prunes {1 - sum(matched) / len(matched):.1%} "
+              "of the files")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return runs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark parts of the Spark ETL on a local session."
+    )
+    parser.add_argument("--cores", default="*",
+                        help="cores of the local master (default: *)")
+    parser.add_argument("--output", default="benchmark_results.json",
+                        help="JSON file to save the results to")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    timestamp = subparsers.add_parser(
+        "timestamp", help="Python UDF vs. native start_time conversion"
+    )
+    timestamp.add_argument("--rows", type=int, default=5000000,
+                           help="number of generated events (default: 5000000)")
+    timestamp.add_argument("--partitions", type=int, default=8,
+                           help="partitions of the events (default: 8)")
+    timestamp.add_argument("--repeat", type=int, default=3,
+                           help="runs per variant (default: 3)")
+    timestamp.add_argument("--variants", nargs="+",
+                           choices=list(timestamp_variants),
+                           default=list(timestamp_variants),
+                           help="conversions to run")
+    timestamp.set_defaults(run=bench_timestamp)
+
+    dedup = subparsers.add_parser(
+        "dedup", help="drop_duplicates vs. latest-wins window deduplication"
+    )
+    dedup.add_argument("--rows", type=int, default=5000000,
+                       help="number of generated events (default: 5000000)")
+    dedup.add_argument("--users", type=int, default=100000,
+                       help="number of distinct users (default: 100000)")
+    dedup.add_argument("--partitions", type=int, default=8,
+                       help="partitions of the events (default: 8)")
+    dedup.add_argument("--variants", nargs="+", choices=list(dedup_variants),
+                       default=list(dedup_variants),
+                       help="deduplications to run")
+    dedup.set_defaults(run=bench_dedup)
+
+    pushdown = subparsers.add_parser(
+        "pushdown", help="point queries on songplays layouts"
+    )
+    pushdown.add_argument("--rows", type=int, default=5000000,
+                          help="number of generated songplays (default: 5000000)")
+    pushdown.add_argument("--users", type=int, default=10000,
+                          help="number of distinct users (default: 10000)")
+    pushdown.add_argument("--songs", type=int, default=100000,
+                          help="number of distinct songs (default: 100000)")
+    pushdown.add_argument("--partitions", type=int, default=8,
+                          help="partitions of the songplays (default: 8)")
+    pushdown.add_argument("--queries", type=int, default=10,
+                          help="queries per column (default: 10)")
+    pushdown.set_defaults(run=bench_pushdown)
+    args = parser.parse_args()
+
+    spark = create_local_session(args.cores)
+    print(f"Running benchmark {args.benchmark} ...")
+    runs = args.run(spark, args)
+    spark.stop()
+
+    results = {"created_at": datetime.now().isoformat(timespec="seconds"),
+               "benchmark": args.benchmark,
+               "args": {k: v for k, v in vars(args).items() if k != "run"},
+               "runs": runs,
+               }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
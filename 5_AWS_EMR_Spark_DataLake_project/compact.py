@@ -0,0 +1,206 @@
+"""
+Compaction job for the parquet tables of the data lake. Rewrites partitions
+holding several small files into files of about the target size and reports
+the file counts and size histograms of the table before and after.
+
+    /usr/bin/spark-submit --master yarn --py-files ... compact.py \
+        s3://sparkify-bucket-output/songs_table.parquet --target-file-mb 128
+
+The rewritten partitions are written into `_compaction` below the table
+first (ignored by readers, like all paths starting with `_`). Then the old
+files of a partition are deleted and the new ones moved in, but only if
+the rewrite produced every partition with the same number of rows.
+Otherwise the job aborts and the table is left unchanged. Don't run it
+while the ETL writes to the same table. If the job fails while swapping,
+the remaining new files are still in `_compaction`. The table metadata
+(`_table_metadata.json`) of a compacted table is regenerated.
+"""
+
+import argparse
+import logging
+import math
+import posixpath
+from collections import Counter, defaultdict
+import hadoop_fs
+from table_metadata import read_table_metadata, write_table_metadata
+from etl import set_aws_credentials, create_spark_session
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+# Upper bounds of the buckets of the size histogram in MB
+size_buckets_mb = [1, 8, 32, 128, 512]
+
+COMPACTION_DIR = "_compaction"
+
+
+def size_histogram(sizes):
+    """Return the number of files per size bucket, e.g. {"<1 MB": 12, ...}."""
+    labels = ([f"<{size_buckets_mb[0]} MB"]
+              + [f"{low}-{high} MB"
+                 for low, high in zip(size_buckets_mb, size_buckets_mb[1:])]
+              + [f">={size_buckets_mb[-1]} MB"])
+    histogram = Counter({label: 0 for label in labels})
+    for size in sizes:
+        bucket = sum(size >= bound * 1024 ** 2 for bound in size_buckets_mb)
+        histogram[labels[bucket]] += 1
+    return dict(histogram)
+
+
+def table_files(spark, path):
+    """Return the data files of a table grouped by partition directory,
+    relative to the table root ("" for an unpartitioned table).
+    """
+    root = path.rstrip("/")
+    partitions = defaultdict(list)
+    for file_path, size in hadoop_fs.list_files(spark, root):
+        relative = file_path.split(root.split("://")[-1], 1)[-1].lstrip("/")
+        partitions[posixpath.dirname(relative)].append((file_path, size))
+    return dict(partitions)
+
+
+def log_file_stats(label, partitions):
+    """Log file count, total size and size histogram of a table."""
+    sizes = [size for files in partitions.values() for _, size in files]
+    logger.info(f"{label}: {len(sizes)} files in {len(partitions)} partitions, "
+                f"{sum(sizes) / 1024 ** 2:.1f} MB")
+    for bucket, count in size_histogram(sizes).items():
+        logger.info(f"  {bucket:>12} {count:>8}")
+
+
+def partition_columns(relative_dir):
+    """Return the partition columns of a partition directory, e.g.
+    ["year", "month"] for "year=2018/month=11".
+    """
+    if not relative_dir:
+        return []
+    return [part.split("=", 1)[0] for part in relative_dir.split("/")]
+
+
+def verify_rewrite(spark, selected, new_partitions, rows):
+    """Check that the rewrite produced files for exactly the selected
+    partitions, with the same total number of rows. Return an error message,
+    None if the rewrite is complete.
+    """
+    missing = sorted(set(selected) - set(new_partitions))
+    unexpected = sorted(set(new_partitions) - set(selected))
+    if missing or unexpected:
+        return (f"partitions missing in the rewrite: {missing[:5]}, "
+                f"unexpected partitions: {unexpected[:5]}")
+    new_rows = spark.read.parquet(*[f for files in new_partitions.values()
+                                    for f, _ in files]).count()
+    if new_rows != rows:
+        return f"{new_rows} rows rewritten instead of {rows}"
+    return None
+
+
+def compact_table(spark, path, target_file_mb, min_file_mb, dry_run=False):
+    """Rewrite the partitions of a table with more than one file smaller
+    than min_file_mb into files of about target_file_mb.
+
+    Returns the number of rewritten partitions.
+    """
+    root = path.rstrip("/")
+    partitions = table_files(spark, root)
+    log_file_stats("Before", partitions)
+
+    selected = {partition: files for partition, files in partitions.items()
+                if sum(size < min_file_mb * 1024 ** 2 for _, size in files) > 1}
+    logger.info(f"{len(selected)} partitions to compact")
+    if dry_run or not selected:
+        return 0
+
+    # Measure the bytes per row of the selected files, footers only
+    selected_files = [f for files in selected.values() for f, _ in files]
+    rows = spark.read.parquet(*selected_files).count()
+    total_bytes = sum(size for files in selected.values() for _, size in files)
+    max_records = max(1, int(target_file_mb * 1024 ** 2 * rows / total_bytes))
+
+    # Rewrite all selected partitions in one job, keeping the partition
+    # columns by reading the directories relative to the table root. The
+    # partition values are read as strings, so the directory names are
+    # written back unchanged (e.g. month=01 is not turned into month=1)
+    columns = partition_columns(next(iter(selected)))
+    tmp_root = f"{root}/{COMPACTION_DIR}"
+    type_inference = "spark.sql.sources.partitionColumnTypeInference.enabled"
+    previous = spark.conf.get(type_inference, "true")
+    spark.conf.set(type_inference, "false")
+    try:
+        df = (spark.read
+              .option("basePath", root)
+              .parquet(*[posixpath.join(root, partition) if partition else root
+                         for partition in selected])
+              )
+        if columns:
+            df = df.repartition(*columns)
+        else:
+            df = df.repartition(max(1, math.ceil(total_bytes
+                                                 / (target_file_mb * 1024 ** 2))))
+        (df.write
+         .option("maxRecordsPerFile", max_records)
+         .parquet(tmp_root, mode="overwrite", partitionBy=columns or None)
+         )
+    finally:
+        spark.conf.set(type_inference, previous)
+
+    # Verify the rewrite before deleting anything
+    new_partitions = table_files(spark, tmp_root)
+    error = verify_rewrite(spark, selected, new_partitions, rows)
+    if error:
+        hadoop_fs.delete(spark, tmp_root, recursive=True)
+        raise RuntimeError(f"Compaction of {root} aborted, table unchanged: {error}")
+
+    # Swap the files partition by partition
+    for partition, files in selected.items():
+        for file_path, _ in files:
+            hadoop_fs.delete(spark, file_path)
+        for file_path, _ in new_partitions.get(partition, []):
+            hadoop_fs.rename(spark, file_path,
+                             posixpath.join(root, partition,
+                                            posixpath.basename(file_path)))
+    hadoop_fs.delete(spark, tmp_root, recursive=True)
+
+    # The table metadata lists the files, so it is regenerated for the same
+    # columns
+    metadata = read_table_metadata(spark, root)
+    if metadata:
+        write_table_metadata(spark, root, list(metadata["columns"]))
+        logger.info(f"Table metadata of {root} regenerated")
+
+    log_file_stats("After", table_files(spark, root))
+    return len(selected)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compact small parquet files of data lake tables."
+    )
+    parser.add_argument("tables", nargs="+", help="URIs of the tables")
+    parser.add_argument("--target-file-mb", type=int, default=128,
+                        help="target file size (default: 128)")
+    parser.add_argument("--min-file-mb", type=int, default=32,
+                        help="files smaller than this are compacted "
+                             "(default: 32)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only report the file statistics")
+    parser.add_argument("--profile",
+                        help="tuning profile of the Spark session in dl.cfg")
+    args = parser.parse_args()
+
+    set_aws_credentials()
+    spark = create_spark_session(args.profile)
+    for table in args.tables:
+        logger.info(f"Compacting {table} ...")
+        compacted = compact_table(spark, table, args.target_file_mb,
+                                  args.min_file_mb, args.dry_run)
+        logger.info(f"{compacted} partitions rewritten.")
+
+
+if __name__ == "__main__":
+    main()
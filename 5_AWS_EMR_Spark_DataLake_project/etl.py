@@ -1,8 +1,12 @@
+import argparse
 import configparser
-from datetime import datetime
+import logging
+import math
 import os
-from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, col, monotonically_increasing_id
+from pyspark import StorageLevel
+from pyspark.sql import SparkSession, Window
+from pyspark.sql import functions as F
+from pyspark.sql.functions import col
 from pyspark.sql.functions import (year,
                                    month,
                                    dayofmonth,
@@ -11,26 +15,470 @@ from pyspark.sql.functions import (year,
                                    dayofweek,
                                    )
 from pyspark.sql.types import TimestampType
+import hadoop_fs
+from ingest_state import IngestState, list_prefixes
+from input_manifest import InputManifest
 from schemas import song_data_schema, log_data_schema
+from spark_metrics import run_metrics
+from table_metadata import write_table_metadata
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+# Durations are rounded before hashing, so float noise doesn't break a match
+DURATION_DECIMALS = 5
+
+# Default target size of the written parquet files
+TARGET_FILE_MB = 128
+
+# Layout of songplays for queries filtering by user and song: rows sorted
+# within the files, bloom filters (parquet 1.12+, i.e. Spark 3.2+, older
+# versions ignore the options) and row groups small enough to be skipped
+SONGPLAYS_SORT_BY = ["user_id", "song_id"]
+SONGPLAYS_BLOOM_FILTER_COLUMNS = ["user_id", "song_id"]
+SONGPLAYS_ROW_GROUP_MB = 32
+
+# Storage of the log events shared by the users, time and songplays writes:
+# a StorageLevel, PARQUET for a temporary columnar checkpoint or NONE
+EVENTS_STORAGE = "MEMORY_AND_DISK"
+events_storage_choices = ["NONE",
+                          "PARQUET",
+                          "MEMORY_ONLY",
+                          "MEMORY_AND_DISK",
+                          "DISK_ONLY",
+                          "MEMORY_ONLY_2",
+                          "MEMORY_AND_DISK_2",
+                          "OFF_HEAP",
+                          ]
+
+
+def set_aws_credentials(config_file="dl.cfg"):
+    """Read the AWS credentials from the config file into the environment.
+    Without [AWS] section, e.g. for local runs, nothing is set.
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    if not config.has_section("AWS"):
+        return
 
-
-config = configparser.ConfigParser()
-config.read("dl.cfg")
-
-os.environ["AWS_ACCESS_KEY_ID"] = config["AWS"].get("AWS_ACCESS_KEY_ID")
-os.environ["AWS_SECRET_ACCESS_KEY"] = config["AWS"].get("AWS_SECRET_ACCESS_KEY")
+    os.environ["AWS_ACCESS_KEY_ID"] = config["AWS"].get("AWS_ACCESS_KEY_ID")
+    os.environ["AWS_SECRET_ACCESS_KEY"] = config["AWS"].get("AWS_SECRET_ACCESS_KEY")
 
 
-def create_spark_session():
-    """Creates as Spark Session"""
-    spark = SparkSession \
+def load_profile(name, config_file="dl.cfg"):
+    """Return the Spark settings of a tuning profile, read from the section
+    [profile:<name>] of the config file. Without name the PROFILE of the
+    [SPARK] section is used, if any. Return the profile name and settings.
+    """
+    parser = configparser.ConfigParser()
+    # Keep the case of the keys, Spark settings are case sensitive
+    parser.optionxform = str
+    parser.read(config_file)
+
+    if name is None:
+        name = parser.get("SPARK", "PROFILE", fallback=None)
+        if name is None:
+            return None, {}
+    section = f"profile:{name}"
+    if not parser.has_section(section):
+        raise Exception(f"Section {section} not found in the {config_file} file.")
+    return name, dict(parser.items(section))
+
+
+def create_spark_session(profile=None, config_file="dl.cfg"):
+    """Creates as Spark Session, tuned with the settings of a profile (see
+    load_profile). The profile and its settings are logged.
+    """
+    name, settings = load_profile(profile, config_file)
+    builder = SparkSession \
         .builder \
         .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
-        .getOrCreate()
+        .config("spark.sql.session.timeZone", "UTC")
+    for key, value in settings.items():
+        builder = builder.config(key, value)
+    spark = builder.getOrCreate()
+
+    logger.info(f"Spark profile: {name or 'none, Spark defaults'}")
+    for key, value in sorted(settings.items()):
+        logger.info(f"  {key}={value}")
+    logger.info("Shuffle partitions: "
+                f"{spark.conf.get('spark.sql.shuffle.partitions')}, "
+                f"default parallelism: {spark.sparkContext.defaultParallelism}")
     return spark
 
 
-def process_song_data(spark, input_data, output_data):
+def add_start_time(df):
+    """Add a start_time timestamp column, converted from the epoch
+    milliseconds in the ts column.
+
+    Runs as native column expression in the JVM, so no row has to be sent
+    through a Python worker. The session time zone is set to UTC in
+    create_spark_session, so start_time holds UTC like the former
+    `datetime.utcfromtimestamp` UDF.
+    """
+    return df.withColumn("start_time",
+                         (col("ts") / 1000).cast(TimestampType())
+                         )
+
+
+def dedup_latest(df, key, order_by=None):
+    """Keep one row per key: the row with the highest order_by values, e.g.
+    the latest ts (latest wins). Ties, and all rows if order_by is omitted,
+    are decided by the remaining columns in ascending order, so the result
+    doesn't depend on the order of the rows (unlike drop_duplicates).
+
+    Parameters
+    ----------
+    df : DataFrame
+    key : list
+        Columns identifying a row of the dimension
+    order_by : list, optional
+        Columns ranking the rows of a key, the highest wins
+
+    The ranking is a window partitioned by key. If df is already hash
+    partitioned by key, e.g. after `repartition(*key)`, Spark reuses that
+    partitioning and adds no shuffle.
+    """
+    order_by = order_by or []
+    tie_breakers = [c for c in df.columns if c not in key and c not in order_by]
+    window = (Window
+              .partitionBy(*key)
+              .orderBy(*[col(c).desc_nulls_last() for c in order_by],
+                       *[col(c).asc_nulls_first() for c in tie_breakers])
+              )
+    return (df
+            .withColumn("_rank", F.row_number().over(window))
+            .where(col("_rank") == 1)
+            .drop("_rank")
+            )
+
+
+def song_key(title, artist_name, duration):
+    """Return a 64 bit hash key of a song, built from its normalized title,
+    artist name and duration. The key is null if any of them is null.
+
+    Two 32 bit murmur3 hashes (`hash` is available since Spark 2.0, unlike
+    `xxhash64`) are combined, so collisions are negligible.
+    """
+    parts = [F.lower(F.trim(title)),
+             F.lower(F.trim(artist_name)),
+             F.round(duration, DURATION_DECIMALS).cast("string"),
+             ]
+    high = F.hash(*parts).cast("long")
+    low = F.hash(*reversed(parts)).cast("long").bitwiseAND(0xFFFFFFFF)
+    return (F.when(title.isNotNull()
+                   & artist_name.isNotNull()
+                   & duration.isNotNull(),
+                   F.shiftLeft(high, 32).bitwiseOR(low))
+            )
+
+
+def songplay_id():
+    """Return a deterministic id of a song play: the MD5 hash of its
+    start_time, user, session and item in session (like the playid of the
+    Airflow pipeline). The same event gets the same id in every run, so ids
+    stay unique across the partitions written by incremental runs.
+    """
+    return F.md5(F.concat_ws("|",
+                             col("start_time").cast("string"),
+                             col("userId"),
+                             col("sessionId").cast("string"),
+                             col("itemInSession").cast("string")))
+
+
+def build_song_lookup(df):
+    """Build the compact song lookup (song_key, song_id, artist_id) from the
+    song data. If several songs share a key, the smallest song_id wins.
+    """
+    return (df
+            .select(song_key(col("title"),
+                             col("artist_name"),
+                             col("duration")).alias("song_key"),
+                    F.struct("song_id", "artist_id").alias("song"))
+            .where(col("song_key").isNotNull())
+            .groupBy("song_key")
+            .agg(F.min("song").alias("song"))
+            .select("song_key", "song.song_id", "song.artist_id")
+            )
+
+
+def resolve_songs(df, song_lookup):
+    """Add song_id and artist_id to the log events by a broadcast join with
+    the song lookup on the hash key. The events are not shuffled, events
+    without a matching song get null ids.
+    """
+    return (df
+            .withColumn("song_key", song_key(col("song"),
+                                             col("artist"),
+                                             col("length")))
+            .join(F.broadcast(song_lookup), "song_key", "left")
+            .drop("song_key")
+            )
+
+
+def join_skew(df, key, top_n=5):
+    """Return the distribution of rows per join key: number of keys, mean
+    and max rows per key and the top_n most frequent keys.
+    """
+    counts = df.groupBy(key).count()
+    stats = counts.agg(F.count("*").alias("keys"),
+                       F.mean("count").alias("mean_rows"),
+                       F.max("count").alias("max_rows"),
+                       ).collect()[0]
+    top_keys = counts.orderBy(col("count").desc()).limit(top_n).collect()
+    return {"keys": stats["keys"],
+            "mean_rows": stats["mean_rows"],
+            "max_rows": stats["max_rows"],
+            "skew": (stats["max_rows"] / stats["mean_rows"]
+                     if stats["mean_rows"] else 0.0),
+            "top_keys": [(row[key], row["count"]) for row in top_keys],
+            }
+
+
+def rows_per_file(spark, df, path, target_file_mb):
+    """Return the number of rows that make a file of about target_file_mb.
+
+    The bytes per row are measured on the existing table if there is one,
+    otherwise Spark's default size estimate of the schema is used. That is
+    an uncompressed size, so the first files written tend to be smaller.
+    """
+    row_bytes = None
+    if hadoop_fs.exists(spark, path):
+        # Parquet row counts come from the file footers, no data is read
+        rows = spark.read.parquet(path).count()
+        if rows:
+            row_bytes = hadoop_fs.content_size(spark, path) / rows
+    if not row_bytes:
+        row_bytes = df._jdf.schema().defaultSize()
+    return max(1, int(target_file_mb * 1024 ** 2 / row_bytes))
+
+
+def size_files(df, partition_by, target_file_mb, max_records=None):
+    """Repartition a DataFrame before a write, so it produces few files of
+    about target_file_mb instead of one file per task and partition value.
+
+    Partitioned tables are repartitioned by the partition columns plus a
+    salt. A partition value with more than max_records rows is spread over
+    ceil(rows / max_records) salts, i.e. tasks writing one file each, so a
+    large month isn't written by a single task. The rows per partition value
+    are counted first (one aggregation). Unpartitioned tables are
+    repartitioned into as many partitions as the size estimate of the query
+    plan needs files.
+    """
+    if partition_by and not max_records:
+        return df.repartition(*partition_by)
+    if partition_by:
+        salts = (df
+                 .groupBy(*partition_by)
+                 .count()
+                 .withColumn("_salts",
+                             F.ceil(col("count") / max_records).cast("int"))
+                 .drop("count")
+                 )
+        # Null-safe join, rows with a null partition value are kept. The
+        # salt is a hash of the row, so a retried task gets the same rows
+        rows, counts = df.alias("rows"), F.broadcast(salts).alias("counts")
+        condition = [col(f"rows.{c}").eqNullSafe(col(f"counts.{c}"))
+                     for c in partition_by]
+        return (rows
+                .join(counts, condition)
+                .select(*[col(f"rows.{c}") for c in df.columns], "_salts")
+                .withColumn("_salt", F.pmod(F.hash(*df.columns), col("_salts")))
+                .repartition(*partition_by, "_salt")
+                .drop("_salts", "_salt")
+                )
+    plan_bytes = int(
+        df._jdf.queryExecution().optimizedPlan().stats().sizeInBytes().toString()
+    )
+    num_files = math.ceil(plan_bytes / (target_file_mb * 1024 ** 2))
+    return df.repartition(max(1, min(num_files, df.rdd.getNumPartitions())))
+
+
+def parquet_options(bloom_filter_columns=None, row_group_mb=None):
+    """Return parquet writer options enabling bloom filters for columns and
+    setting the row group size. Min/max statistics per row group and column
+    are written by default.
+    """
+    options = {f"parquet.bloom.filter.enabled#{column}": "true"
+               for column in bloom_filter_columns or []}
+    if row_group_mb:
+        options["parquet.block.size"] = str(row_group_mb * 1024 ** 2)
+    return options
+
+
+def write_table(spark, df, path, partition_by=None, key=None,
+                incremental=False, target_file_mb=TARGET_FILE_MB,
+                sort_by=None, options=None, order_by=None):
+    """Write a table to parquet files of about target_file_mb.
+
+    The rows of every file can be sorted by sort_by, so the min/max
+    statistics of the row groups allow to skip most of them when filtering
+    by these columns. options are passed to the parquet writer.
+
+    A full run overwrites the table. In an incremental run a table with a
+    key gets only the rows with new keys appended (append-with-dedup), a
+    table without key gets the partitions contained in df replaced (dynamic
+    partition overwrite), all other partitions are kept. A table with a key
+    and order_by is merged instead: the existing and the new rows are
+    deduplicated with dedup_latest and the table is overwritten, so the
+    latest row of a key wins across runs.
+
+    The Spark metrics of the write are recorded in run_metrics, named after
+    the table directory, e.g. songs_table.
+    """
+    table_name = os.path.basename(path.rstrip("/")).replace(".parquet", "")
+    with run_metrics.table(spark, table_name):
+        max_records = rows_per_file(spark, df, path, target_file_mb)
+        staged = None
+        if (incremental and key is not None and order_by
+                and hadoop_fs.exists(spark, path)):
+            df, staged = merge_latest(spark, df, path, key, order_by)
+            mode = "overwrite"
+        elif incremental and key is not None and hadoop_fs.exists(spark, path):
+            existing_keys = spark.read.parquet(path).select(key)
+            df = df.join(existing_keys, key, "left_anti")
+            mode = "append"
+        else:
+            mode = "overwrite"
+
+        df = size_files(df, partition_by, target_file_mb, max_records)
+        if sort_by:
+            # The writer needs the rows sorted by partition first
+            df = df.sortWithinPartitions(*(partition_by or []), *sort_by)
+        writer = (df
+                  .write
+                  .options(**(options or {}))
+                  .option("maxRecordsPerFile", max_records)
+                  )
+        if incremental and key is None:
+            conf = "spark.sql.sources.partitionOverwriteMode"
+            previous = spark.conf.get(conf, "static")
+            spark.conf.set(conf, "dynamic")
+            try:
+                writer.parquet(path, mode=mode, partitionBy=partition_by)
+            finally:
+                spark.conf.set(conf, previous)
+        else:
+            writer.parquet(path, mode=mode, partitionBy=partition_by)
+        if staged:
+            hadoop_fs.delete(spark, staged, recursive=True)
+
+
+def merge_latest(spark, df, path, key, order_by):
+    """Merge new rows into an existing keyed table, the latest row of a key
+    wins (dedup_latest). Columns missing in the existing table are NULL and
+    rank last.
+
+    A table can't be overwritten while it is read, so the merged rows are
+    staged in `_tmp` next to the table first. Return the DataFrame of the
+    staged rows and the staging path, to be deleted after the write.
+    """
+    existing = spark.read.parquet(path)
+    for column in df.columns:
+        if column not in existing.columns:
+            existing = existing.withColumn(
+                column, F.lit(None).cast(df.schema[column].dataType)
+            )
+    merged = dedup_latest(existing.select(*df.columns).unionByName(df),
+                          [key] if isinstance(key, str) else key,
+                          order_by)
+
+    staged = os.path.join(os.path.dirname(path.rstrip("/")), "_tmp",
+                          os.path.basename(path.rstrip("/")))
+    merged.write.parquet(staged, mode="overwrite")
+    return spark.read.parquet(staged), staged
+
+
+def set_input_partitions(spark, files, num_partitions):
+    """Set the split size of the file sources, so the files are packed into
+    num_partitions evenly sized input partitions. Every file counts with
+    its size plus the open cost (spark.sql.files.openCostInBytes).
+
+    Spark plans the splits when an action runs, so the setting holds for
+    the rest of the session, not just for one read.
+    """
+    open_cost = int(spark.conf.get("spark.sql.files.openCostInBytes",
+                                   str(4 * 1024 ** 2)))
+    total_bytes = sum(size + open_cost for _, size in files)
+    split_bytes = max(open_cost, math.ceil(total_bytes / num_partitions))
+    spark.conf.set("spark.sql.files.maxPartitionBytes", str(split_bytes))
+    logger.info(f"{len(files)} files, {total_bytes / 1024 ** 2:.1f} MB "
+                f"incl. open cost, split into {num_partitions} partitions "
+                f"of {split_bytes / 1024 ** 2:.1f} MB")
+
+
+def read_input(spark, input_data, dataset, pattern, schema, state=None,
+               manifest=None, input_partitions=None):
+    """Read the JSON files of a dataset. Return the DataFrame and the
+    prefixes read, the DataFrame is None if there is no new data.
+
+    Without state and manifest all files matching the pattern are read.
+    With state only the prefixes not consumed yet are read. With manifest
+    exactly the files listed in the manifest are read, split into
+    input_partitions evenly sized partitions (default: twice the default
+    parallelism).
+    """
+    if state is None and manifest is None:
+        return spark.read.json(os.path.join(input_data, dataset, pattern),
+                               schema=schema), []
+
+    prefixes = list_prefixes(spark, input_data, dataset)
+    if state is not None:
+        prefixes = state.new_prefixes(dataset, prefixes)
+        logger.info(f"{dataset}: {len(prefixes)} new prefixes")
+    if not prefixes:
+        return None, prefixes
+
+    if manifest is None:
+        paths = [os.path.join(prefix, "*.json") for prefix in prefixes]
+    else:
+        files = manifest.files(dataset, prefixes)
+        if not files:
+            return None, prefixes
+        set_input_partitions(
+            spark, files,
+            input_partitions or 2 * spark.sparkContext.defaultParallelism
+        )
+        paths = [path for path, _ in files]
+    return spark.read.json(paths, schema=schema), prefixes
+
+
+def persist_events(spark, df, storage, checkpoint_path):
+    """Materialize the log events read by several table writes, so the JSON
+    source is scanned and parsed only once. Return the events and a
+    function releasing them.
+
+    storage is one of events_storage_choices. With PARQUET the events are
+    written to a temporary parquet checkpoint at checkpoint_path and read
+    back, NONE keeps them unmaterialized.
+    """
+    if storage == "NONE":
+        return df, lambda: None
+    if storage == "PARQUET":
+        with run_metrics.table(spark, "events_checkpoint"):
+            df.write.parquet(checkpoint_path, mode="overwrite")
+        return (spark.read.parquet(checkpoint_path),
+                lambda: hadoop_fs.delete(spark, checkpoint_path, recursive=True))
+    events = df.persist(getattr(StorageLevel, storage))
+    return events, events.unpersist
+
+
+def log_scans_saved(storage, actions):
+    """Log how many scans of the log data the materialized events saved."""
+    scans = actions if storage == "NONE" else 1
+    logger.info(f"Events ({storage}) read by {actions} actions: log data "
+                f"scanned {scans} times, {actions - scans} scans saved")
+
+
+def process_song_data(spark, input_data, output_data, state=None,
+                      target_file_mb=TARGET_FILE_MB, manifest=None,
+                      input_partitions=None):
     """Process song data from S3, generate song and artist data.
 
     Parameters
@@ -40,42 +488,78 @@ def process_song_data(spark, input_data, output_data):
         S3 URI for song data input
     output_data : string
         S3 URI for song and artist data output
+    state : IngestState, optional
+        If passed, run incrementally: process only the song data prefixes
+        not consumed yet and append new songs and artists
+    target_file_mb : int
+        Target size of the written parquet files
+    manifest : InputManifest, optional
+        If passed, read the song files listed in the manifest
+    input_partitions : int, optional
+        Number of input partitions of the files read with manifest
     """
+    incremental = state is not None
 
     # Get filepath to song data file and read into dataframe
-    song_data = os.path.join(input_data, "song-data", "*", "*", "*", "*.json")
-    df = spark.read.json(song_data, schema=song_data_schema)
+    df, prefixes = read_input(spark, input_data, "song-data",
+                              os.path.join("*", "*", "*", "*.json"),
+                              song_data_schema, state, manifest,
+                              input_partitions)
+    if df is None:
+        return
     # Extract columns to create songs table
-    songs_table = df.select("song_id",
-                            "title",
-                            "artist_id",
-                            "year",
-                            "duration",
-                            ).drop_duplicates()
+    songs_table = dedup_latest(df.select("song_id",
+                                         "title",
+                                         "artist_id",
+                                         "year",
+                                         "duration",
+                                         ),
+                               ["song_id"]
+                               )
 
     # Write songs table to parquet files partitioned by year and artist
-    songs_table.write.parquet(
-        os.path.join(output_data, "songs_table.parquet"),
-        mode="overwrite",
-        partitionBy=["year", "artist_id"]
-    )
+    write_table(spark, songs_table,
+                os.path.join(output_data, "songs_table.parquet"),
+                partition_by=["year", "artist_id"],
+                key="song_id",
+                incremental=incremental,
+                target_file_mb=target_file_mb
+                )
 
     # Extract columns to create artists table
-    artists_table = df.select("artist_id",
-                              col("artist_name").alias("name"),
-                              col("artist_location").alias("location"),
-                              col("artist_latitude").alias("latitude"),
-                              col("artist_longitude").alias("longitude")
-                              ).drop_duplicates()
+    artists_table = dedup_latest(df.select("artist_id",
+                                           col("artist_name").alias("name"),
+                                           col("artist_location").alias("location"),
+                                           col("artist_latitude").alias("latitude"),
+                                           col("artist_longitude").alias("longitude")
+                                           ),
+                                 ["artist_id"]
+                                 )
 
     # Write artists table to parquet files
-    artists_table.write.parquet(
-        os.path.join(output_data, "artists_table.parquet"),
-        mode="overwrite"
-    )
-
-
-def process_log_data(spark, input_data, output_data):
+    write_table(spark, artists_table,
+                os.path.join(output_data, "artists_table.parquet"),
+                key="artist_id",
+                incremental=incremental,
+                target_file_mb=target_file_mb
+                )
+
+    # Build the lookup used to resolve the songs of the log events
+    song_lookup = build_song_lookup(df)
+    write_table(spark, song_lookup,
+                os.path.join(output_data, "song_lookup.parquet"),
+                key="song_key",
+                incremental=incremental,
+                target_file_mb=target_file_mb
+                )
+
+    if incremental:
+        state.add("song-data", prefixes)
+
+
+def process_log_data(spark, input_data, output_data, report_skew=False,
+                     state=None, target_file_mb=TARGET_FILE_MB, manifest=None,
+                     input_partitions=None, events_storage=EVENTS_STORAGE):
     """Process song data from S3, generate users, time and songplays data.
 
     Parameters
@@ -85,36 +569,69 @@ def process_log_data(spark, input_data, output_data):
         S3 URI for song data input
     output_data : string
         S3 URI for song and artist data output
+    report_skew : bool
+        If True, log the distribution of the events per song key (costs an
+        extra pass over the events)
+    state : IngestState, optional
+        If passed, run incrementally: process only the log data prefixes
+        (months) not consumed yet, replace the affected time and songplays
+        partitions and append new users
+    target_file_mb : int
+        Target size of the written parquet files
+    manifest : InputManifest, optional
+        If passed, read the log files listed in the manifest
+    input_partitions : int, optional
+        Number of input partitions of the files read with manifest
+    events_storage : string
+        How the filtered events are materialized for the table writes, one
+        of events_storage_choices
     """
+    incremental = state is not None
 
     # Get filepath to log data file and read into dataframe
-    log_data = os.path.join(input_data, "log-data", "*", "*", "*.json")
-    df = spark.read.json(log_data, schema=log_data_schema)
+    df, prefixes = read_input(spark, input_data, "log-data",
+                              os.path.join("*", "*", "*.json"),
+                              log_data_schema, state, manifest,
+                              input_partitions)
+    if df is None:
+        return
     # Filter by actions for song plays
     df = df.filter(col("page") == "NextSong")
 
-    # Extract columns for users table
-    users_table = df.select(col("userId").alias("user_id"),
-                            col("firstName").alias("first_name"),
-                            col("lastName").alias("last_name"),
-                            "gender",
-                            "level"
-                            ).drop_duplicates(["user_id"])
-
-    # Write users table to parquet files
-    users_table.write.parquet(
-        os.path.join(output_data, "users_table.parquet"),
-        mode="overwrite",
-    )
-
     # Create datetime column from original timestamp column
-    get_datetime = udf(lambda x: datetime.utcfromtimestamp(x / 1000),
-                       TimestampType()
-                       )
+    df = add_start_time(df)
 
-    df = df.withColumn("start_time", get_datetime("ts"))
+    # Materialize the events once for all tables derived from them
+    df, release_events = persist_events(
+        spark, df, events_storage,
+        os.path.join(output_data, "_tmp", "events.parquet")
+    )
+    actions = 0
+
+    # Extract columns for users table, the latest event of a user wins. The
+    # ts of that event is kept, so incremental runs can merge by it
+    users_table = dedup_latest(df.select(col("userId").alias("user_id"),
+                                         col("firstName").alias("first_name"),
+                                         col("lastName").alias("last_name"),
+                                         "gender",
+                                         "level",
+                                         "ts"
+                                         ),
+                               ["user_id"],
+                               ["ts"]
+                               )
 
-    # Extract columns to create time table
+    # Write users table to parquet files
+    write_table(spark, users_table,
+                os.path.join(output_data, "users_table.parquet"),
+                key="user_id",
+                incremental=incremental,
+                target_file_mb=target_file_mb,
+                order_by=["ts"]
+                )
+    actions += 1
+
+    # Extract columns to create time table, one row per start_time
     time_table = (df
                   .withColumn("hour", hour("start_time"))
                   .withColumn("day", dayofmonth("start_time"))
@@ -129,50 +646,40 @@ def process_log_data(spark, input_data, output_data):
                           "month",
                           "year",
                           "weekday"
-                          ).drop_duplicates(["year",
-                                             "month",
-                                             "day",
-                                             "hour"]
-                                            )
+                          )
                   )
+    time_table = dedup_latest(time_table, ["start_time"])
 
     # Write time table to parquet files partitioned by year and month
-    time_table.write.parquet(
-        os.path.join(output_data, "time_table.parquet"),
-        mode="overwrite",
-        partitionBy=["year", "month"]
-    )
-
-    # Read in song data to use for songplays table
-    artists_df = spark.read.parquet(
-        os.path.join(output_data, "artists_table.parquet")
-    )
-
-    songs_df = spark.read.parquet(
-        os.path.join(output_data, "songs_table.parquet")
+    write_table(spark, time_table,
+                os.path.join(output_data, "time_table.parquet"),
+                partition_by=["year", "month"],
+                incremental=incremental,
+                target_file_mb=target_file_mb
+                )
+    actions += 1
+
+    # Read in the song lookup built from the song data, to resolve songs
+    song_lookup = spark.read.parquet(
+        os.path.join(output_data, "song_lookup.parquet")
     )
+    logger.info(f"Song lookup: {song_lookup.count()} keys (broadcast)")
+
+    if report_skew:
+        with run_metrics.table(spark, "song_key_skew"):
+            skew = join_skew(df.withColumn("song_key",
+                                           song_key(col("song"),
+                                                    col("artist"),
+                                                    col("length"))),
+                             "song_key")
+        actions += 2
+        logger.info(f"Events per song key: {skew['keys']} keys, "
+                    f"mean {skew['mean_rows']:.1f}, max {skew['max_rows']} "
+                    f"(skew {skew['skew']:.1f}), top keys {skew['top_keys']}")
 
     # Extract columns from joined song and log datasets to create songplays table
-    songs = (songs_df
-             .join(artists_df, "artist_id", "inner")
-             .select("song_id",
-                     "title",
-                     "artist_id",
-                     col("name").alias("artist_name"),
-                     "duration"
-                     )
-             ).drop_duplicates()
-
-    songplays_table = (df
-                       .join(songs,
-                             [df.song == songs.title,
-                              df.artist == songs.artist_name,
-                              df.length == songs.duration
-                              ], "left")
-                       )
-
-    songplays_table = (songplays_table
-                       .select(monotonically_increasing_id().alias("songplay_id"),
+    songplays_table = (resolve_songs(df, song_lookup)
+                       .select(songplay_id().alias("songplay_id"),
                                "start_time",
                                col("userId").alias("user_id"),
                                "level",
@@ -186,23 +693,109 @@ def process_log_data(spark, input_data, output_data):
                                )
                        )
 
-    # Write songplays table to parquet files partitioned by year and month
-    songplays_table.write.parquet(
-        os.path.join(output_data, "songplays_table.parquet"),
-        mode="overwrite",
-        partitionBy=["year", "month"]
-    )
+    # Write songplays table to parquet files partitioned by year and month,
+    # laid out for filters on user and song
+    songplays_path = os.path.join(output_data, "songplays_table.parquet")
+    write_table(spark, songplays_table,
+                songplays_path,
+                partition_by=["year", "month"],
+                incremental=incremental,
+                target_file_mb=target_file_mb,
+                sort_by=SONGPLAYS_SORT_BY,
+                options=parquet_options(SONGPLAYS_BLOOM_FILTER_COLUMNS,
+                                        SONGPLAYS_ROW_GROUP_MB)
+                )
+    actions += 1
+    with run_metrics.table(spark, "songplays_table_metadata"):
+        write_table_metadata(spark, songplays_path,
+                             ["start_time", "user_id", "song_id", "artist_id",
+                              "session_id", "year", "month"])
+
+    # Release the events after the last write
+    release_events()
+    log_scans_saved(events_storage, actions)
+
+    if incremental:
+        state.add("log-data", prefixes)
+
+
+def parse_args():
+    """Parse the command line arguments of the ETL."""
+    parser = argparse.ArgumentParser(description="Run the Sparkify data lake ETL.")
+    parser.add_argument("--profile",
+                        help="tuning profile of the Spark session, a "
+                             "[profile:<name>] section in dl.cfg "
+                             "(default: PROFILE of the [SPARK] section)")
+    parser.add_argument("--input-data", default="s3a://udacity-dend/",
+                        help="URI of the input data (default: %(default)s)")
+    # s3:// is EMRFS on EMR, whose S3-optimized committer the profiles enable
+    parser.add_argument("--output-data", default="s3://sparkify-bucket-output/",
+                        help="URI of the output data (default: %(default)s)")
+    parser.add_argument("--report-skew", action="store_true",
+                        help="log the distribution of log events per song key")
+    parser.add_argument("--incremental", action="store_true",
+                        help="process only input prefixes not consumed yet")
+    parser.add_argument("--target-file-mb", type=int, default=TARGET_FILE_MB,
+                        help="target size of the written parquet files "
+                             f"(default: {TARGET_FILE_MB})")
+    parser.add_argument("--events-storage", choices=events_storage_choices,
+                        default=EVENTS_STORAGE,
+                        help="materialization of the log events shared by the "
+                             "users, time and songplays writes "
+                             f"(default: {EVENTS_STORAGE})")
+    parser.add_argument("--report-dir",
+                        help="directory of the JSON and HTML run reports "
+                             "(default: run_reports in the output data)")
+    parser.add_argument("--state-file",
+                        help="state file of the incremental mode "
+                             "(default: etl_state.json in the output data)")
+    parser.add_argument("--manifest", action="store_true",
+                        help="read the input files listed in a manifest")
+    parser.add_argument("--manifest-file",
+                        help="manifest of the input files "
+                             "(default: input_manifest.json in the output data)")
+    parser.add_argument("--refresh-manifest", action="store_true",
+                        help="list all input prefixes again")
+    parser.add_argument("--input-partitions", type=int,
+                        help="input partitions of the files read with manifest "
+                             "(default: twice the default parallelism)")
+    return parser.parse_args()
 
 
 def main():
     """Runs ETL pipeline job."""
-
-    spark = create_spark_session()
-    input_data = "s3a://udacity-dend/"
-    output_data = "s3a://sparkify-bucket-output/"
-
-    process_song_data(spark, input_data, output_data)
-    process_log_data(spark, input_data, output_data)
+    args = parse_args()
+
+    set_aws_credentials()
+    spark = create_spark_session(args.profile)
+    input_data = args.input_data
+    output_data = args.output_data
+
+    state = None
+    if args.incremental:
+        state_file = args.state_file or os.path.join(output_data,
+                                                     "etl_state.json")
+        state = IngestState(spark, state_file)
+
+    manifest = None
+    if args.manifest:
+        manifest_file = args.manifest_file or os.path.join(output_data,
+                                                           "input_manifest.json")
+        manifest = InputManifest(spark, manifest_file,
+                                 refresh=args.refresh_manifest)
+
+    process_song_data(spark, input_data, output_data, state=state,
+                      target_file_mb=args.target_file_mb, manifest=manifest,
+                      input_partitions=args.input_partitions)
+    process_log_data(spark, input_data, output_data,
+                     report_skew=args.report_skew, state=state,
+                     target_file_mb=args.target_file_mb, manifest=manifest,
+                     input_partitions=args.input_partitions,
+                     events_storage=args.events_storage)
+
+    report_dir = args.report_dir or os.path.join(output_data, "run_reports")
+    report = run_metrics.write_report(spark, report_dir)
+    logger.info(f"Run report written to {report}")
 
 
 if __name__ == "__main__":
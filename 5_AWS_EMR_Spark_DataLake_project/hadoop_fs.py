@@ -0,0 +1,105 @@
+"""
+Small helpers around the Hadoop FileSystem API of the Spark JVM. They work
+with every path Spark can read, e.g. `s3a://` on EMR and local paths for
+development, without extra Python dependencies.
+"""
+
+
+def _path(spark, path):
+    """Return the Hadoop Path and its FileSystem."""
+    jvm = spark.sparkContext._jvm
+    hadoop_path = jvm.org.apache.hadoop.fs.Path(path)
+    fs = hadoop_path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration())
+    return hadoop_path, fs
+
+
+def exists(spark, path):
+    """Check if a file or directory exists."""
+    hadoop_path, fs = _path(spark, path)
+    return fs.exists(hadoop_path)
+
+
+def glob(spark, pattern, directories_only=False):
+    """Return the sorted paths matching a glob pattern, e.g.
+    `s3a://bucket/log-data/*/*`.
+    """
+    hadoop_path, fs = _path(spark, pattern)
+    statuses = fs.globStatus(hadoop_path) or []
+    return sorted(status.getPath().toString() for status in statuses
+                  if not directories_only or status.isDirectory())
+
+
+def read_text(spark, path):
+    """Return the content of a (small) text file, None if it doesn't exist."""
+    hadoop_path, fs = _path(spark, path)
+    if not fs.exists(hadoop_path):
+        return None
+    jvm = spark.sparkContext._jvm
+    stream = fs.open(hadoop_path)
+    try:
+        return jvm.org.apache.commons.io.IOUtils.toString(stream, "UTF-8")
+    finally:
+        stream.close()
+
+
+def write_text(spark, path, text):
+    """Write a (small) text file, an existing file is replaced."""
+    hadoop_path, fs = _path(spark, path)
+    stream = fs.create(hadoop_path, True)
+    try:
+        stream.write(bytearray(text.encode("utf-8")))
+    finally:
+        stream.close()
+
+
+def list_files(spark, path):
+    """Return (path, size) of all data files below a directory, recursively.
+    Hidden files and directories (starting with `_` or `.`, e.g. _SUCCESS)
+    are skipped, like Spark does when reading a table.
+    """
+    hadoop_path, fs = _path(spark, path)
+    if not fs.exists(hadoop_path):
+        return []
+    root = fs.getFileStatus(hadoop_path).getPath().toString().rstrip("/")
+    files = []
+    iterator = fs.listFiles(hadoop_path, True)
+    while iterator.hasNext():
+        status = iterator.next()
+        file_path = status.getPath().toString()
+        relative = file_path[len(root):].lstrip("/")
+        if any(part.startswith(("_", ".")) for part in relative.split("/")):
+            continue
+        files.append((file_path, status.getLen()))
+    return files
+
+
+def content_size(spark, path):
+    """Return the total size in bytes of all files below a path."""
+    hadoop_path, fs = _path(spark, path)
+    return fs.getContentSummary(hadoop_path).getLength()
+
+
+def delete(spark, path, recursive=False):
+    """Delete a file or directory."""
+    hadoop_path, fs = _path(spark, path)
+    return fs.delete(hadoop_path, recursive)
+
+
+def rename(spark, source, target):
+    """Move a file or directory, the parent of the target is created."""
+    source_path, fs = _path(spark, source)
+    target_path, _ = _path(spark, target)
+    fs.mkdirs(target_path.getParent())
+    return fs.rename(source_path, target_path)
+
+
+def list_dir_files(spark, path, suffix=""):
+    """Return (path, size) of the files directly in a directory whose name
+    ends with suffix, e.g. ".json".
+    """
+    hadoop_path, fs = _path(spark, path)
+    if not fs.exists(hadoop_path):
+        return []
+    return sorted((status.getPath().toString(), status.getLen())
+                  for status in fs.listStatus(hadoop_path)
+                  if status.isFile() and status.getPath().getName().endswith(suffix))
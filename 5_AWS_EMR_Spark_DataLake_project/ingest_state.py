@@ -0,0 +1,56 @@
+"""
+State of the incremental ETL: the input prefixes (song-data/A/B/C,
+log-data/2018/11) that have been consumed. The state is a small JSON file,
+by default next to the output tables, so it survives the EMR cluster:
+
+    {"song-data": ["s3a://.../song-data/A/A/A", ...],
+     "log-data": ["s3a://.../log-data/2018/11", ...]}
+
+A prefix is recorded only after all tables derived from it were written. It
+is treated as complete, files added to it later are not picked up.
+"""
+
+import json
+import hadoop_fs
+
+# Glob of the input prefixes per dataset, relative to the input data
+prefix_globs = {"song-data": "song-data/*/*/*",
+                "log-data": "log-data/*/*",
+                }
+
+
+def list_prefixes(spark, input_data, dataset):
+    """Return the input prefixes (directories) of a dataset."""
+    return hadoop_fs.glob(spark,
+                          input_data.rstrip("/") + "/" + prefix_globs[dataset],
+                          directories_only=True
+                          )
+
+
+class IngestState:
+    """Consumed input prefixes, read from and saved to a JSON state file.
+
+    Parameters
+    ----------
+    spark : SparkSession object
+    path : string
+        URI of the state file
+    """
+
+    def __init__(self, spark, path):
+        self.spark = spark
+        self.path = path
+        text = hadoop_fs.read_text(spark, path)
+        self.consumed = json.loads(text) if text else {}
+
+    def new_prefixes(self, dataset, prefixes):
+        """Return the prefixes of a dataset not consumed yet."""
+        consumed = set(self.consumed.get(dataset, []))
+        return [prefix for prefix in prefixes if prefix not in consumed]
+
+    def add(self, dataset, prefixes):
+        """Mark prefixes of a dataset as consumed and save the state file."""
+        self.consumed[dataset] = sorted(set(self.consumed.get(dataset, []))
+                                        | set(prefixes))
+        hadoop_fs.write_text(self.spark, self.path,
+                             json.dumps(self.consumed, indent=2))
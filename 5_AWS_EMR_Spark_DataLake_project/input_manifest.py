@@ -0,0 +1,67 @@
+"""
+Manifest of the input files of the ETL. Listing the song-data and log-data
+globs on S3 takes minutes, most of it listing the files of each of the many
+leaf directories. The manifest stores the files and their sizes per input
+prefix (song-data/A/B/C, log-data/2018/11):
+
+    {"song-data": {"s3a://.../song-data/A/A/A": [["TRAAAAW128F429D538.json", 312],
+                                                 ...],
+                   ...},
+     "log-data": {...}}
+
+A run lists only the prefixes, the files of prefixes already in the manifest
+are taken from it. New prefixes are listed (in parallel) and added.
+"""
+
+import json
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+import hadoop_fs
+
+# Number of threads listing prefixes on the driver
+LIST_THREADS = 32
+
+
+class InputManifest:
+    """Input files with sizes per dataset and prefix, read from and saved to
+    a JSON manifest file.
+
+    Parameters
+    ----------
+    spark : SparkSession object
+    path : string
+        URI of the manifest file
+    refresh : bool
+        If True, list all prefixes again instead of reusing the manifest
+    """
+
+    def __init__(self, spark, path, refresh=False):
+        self.spark = spark
+        self.path = path
+        text = None if refresh else hadoop_fs.read_text(spark, path)
+        self.listed = json.loads(text) if text else {}
+
+    def _list_prefix(self, prefix):
+        return [[posixpath.basename(file_path), size]
+                for file_path, size
+                in hadoop_fs.list_dir_files(self.spark, prefix, ".json")]
+
+    def files(self, dataset, prefixes):
+        """Return (path, size) of the JSON files in the given prefixes of a
+        dataset. Prefixes missing in the manifest are listed and added.
+        """
+        listed = self.listed.setdefault(dataset, {})
+        missing = [prefix for prefix in prefixes if prefix not in listed]
+        if missing:
+            with ThreadPoolExecutor(LIST_THREADS) as executor:
+                for prefix, files in zip(missing,
+                                         executor.map(self._list_prefix, missing)):
+                    listed[prefix] = files
+            self.save()
+        return [(f"{prefix}/{name}", size)
+                for prefix in prefixes
+                for name, size in listed[prefix]]
+
+    def save(self):
+        """Write the manifest file."""
+        hadoop_fs.write_text(self.spark, self.path, json.dumps(self.listed))
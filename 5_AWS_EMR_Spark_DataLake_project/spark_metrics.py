@@ -0,0 +1,275 @@
+"""
+Collect Spark stage metrics of the jobs run in a with block. The jobs are
+tagged with a job group, the status tracker maps the group to its stages and
+the stage metrics are read from the monitoring REST API of the Spark UI:
+
+    with job_group(spark, "songplays"):
+        songplays_table.write.parquet(...)
+    totals = summarize_stages(group_stages(spark, "songplays"))
+
+`run_metrics` records these metrics per table write of a run, plus the task
+skew per stage, and writes them to a JSON and HTML run report.
+"""
+
+import html
+import json
+import logging
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.request import urlopen
+import hadoop_fs
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+# Stage fields of the REST API summed up per job group. Times in ms, except
+# executorCpuTime in ns.
+stage_metric_fields = ["executorRunTime",
+                       "executorCpuTime",
+                       "inputBytes",
+                       "inputRecords",
+                       "outputBytes",
+                       "outputRecords",
+                       "shuffleReadBytes",
+                       "shuffleWriteBytes",
+                       "memoryBytesSpilled",
+                       "diskBytesSpilled",
+                       "numTasks",
+                       ]
+
+
+def rest_api(spark, endpoint):
+    """Return the JSON response of an application endpoint of the REST API,
+    e.g. `stages/3`.
+    """
+    sc = spark.sparkContext
+    url = f"{sc.uiWebUrl}/api/v1/applications/{sc.applicationId}/{endpoint}"
+    with urlopen(url) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+@contextmanager
+def job_group(spark, name):
+    """Tag all jobs started in the with block with a job group."""
+    sc = spark.sparkContext
+    sc.setLocalProperty("spark.jobGroup.id", name)
+    sc.setLocalProperty("spark.job.description", name)
+    try:
+        yield
+    finally:
+        sc.setLocalProperty("spark.jobGroup.id", None)
+        sc.setLocalProperty("spark.job.description", None)
+
+
+def group_stages(spark, name, timeout=10):
+    """Return the REST API records of all stage attempts run by the jobs of
+    a job group.
+
+    The UI is updated asynchronously, so stages still reported as active
+    are polled again until `timeout` seconds have passed.
+    """
+    tracker = spark.sparkContext.statusTracker()
+    stage_ids = set()
+    for job_id in tracker.getJobIdsForGroup(name):
+        job = tracker.getJobInfo(job_id)
+        if job is not None:
+            stage_ids.update(job.stageIds)
+
+    deadline = time.time() + timeout
+    while True:
+        stages = [attempt
+                  for stage_id in sorted(stage_ids)
+                  for attempt in rest_api(spark, f"stages/{stage_id}")
+                  ]
+        if time.time() > deadline or not any(
+                stage["status"] == "ACTIVE" for stage in stages):
+            return stages
+        time.sleep(0.5)
+
+
+def summarize_stages(stages):
+    """Sum up the metrics of a list of stage attempts. Skipped stages, e.g.
+    reused shuffle output, are not counted.
+    """
+    totals = {field: 0 for field in stage_metric_fields}
+    totals["stages"] = 0
+    for stage in stages:
+        if stage["status"] == "SKIPPED":
+            continue
+        totals["stages"] += 1
+        for field in stage_metric_fields:
+            totals[field] += stage.get(field, 0)
+    return totals
+
+
+def stage_seconds(stage):
+    """Return the duration of a stage attempt in seconds (0 if unknown)."""
+    if not stage.get("submissionTime") or not stage.get("completionTime"):
+        return 0.0
+    # The REST API reports times like 2020-05-01T12:00:00.123GMT
+    start, end = (datetime.strptime(stage[key][:23], "%Y-%m-%dT%H:%M:%S.%f")
+                  for key in ["submissionTime", "completionTime"])
+    return (end - start).total_seconds()
+
+
+def task_skew(spark, stage):
+    """Return the median and max task run time (ms) of a stage attempt and
+    their ratio, the skew.
+    """
+    summary = rest_api(spark, f"stages/{stage['stageId']}/{stage['attemptId']}"
+                              "/taskSummary?quantiles=0.5,1.0")
+    median, longest = summary["executorRunTime"]
+    return {"median_task_ms": median,
+            "max_task_ms": longest,
+            "skew": longest / median if median else 0.0,
+            }
+
+
+class RunMetrics:
+    """Stage metrics per table write of an ETL run.
+
+    Every table write is run in a job group named after the table:
+
+        with run_metrics.table(spark, "songplays"):
+            songplays_table.write.parquet(...)
+
+    The metrics are read from the REST API after the write. If the Spark UI
+    is disabled, the tables are recorded with their wall time only.
+    """
+
+    def __init__(self):
+        self.started_at = datetime.now()
+        self.tables = []
+
+    @contextmanager
+    def table(self, spark, name):
+        """Record the stage metrics of the jobs run in the with block."""
+        group = f"{name}-{len(self.tables)}"
+        record = {"table": name, "stages": []}
+        start = time.perf_counter()
+        with job_group(spark, group):
+            yield record
+        record["wall_time_s"] = time.perf_counter() - start
+        try:
+            stages = group_stages(spark, group)
+            record["stages"] = [self._stage_record(spark, stage)
+                                for stage in stages]
+            record["totals"] = summarize_stages(stages)
+        except (OSError, ValueError) as error:
+            logger.warning(f"No stage metrics for {name}: {error}")
+            record["totals"] = {}
+        self.tables.append(record)
+        self._log(record)
+
+    @staticmethod
+    def _stage_record(spark, stage):
+        record = {"stage_id": stage["stageId"],
+                  "attempt": stage["attemptId"],
+                  "name": stage["name"],
+                  "status": stage["status"],
+                  "duration_s": stage_seconds(stage),
+                  **{field: stage.get(field, 0) for field in stage_metric_fields},
+                  }
+        if stage["status"] == "COMPLETE":
+            record.update(task_skew(spark, stage))
+        return record
+
+    @staticmethod
+    def _log(record):
+        totals = record["totals"]
+        if not totals:
+            logger.info(f"{record['table']}: {record['wall_time_s']:.1f} s")
+            return
+        skew = max([stage.get("skew", 0.0) for stage in record["stages"]],
+                   default=0.0)
+        logger.info(f"{record['table']}: {record['wall_time_s']:.1f} s, "
+                    f"{totals['stages']} stages, "
+                    f"input {totals['inputBytes'] / 1024 ** 2:.1f} MB, "
+                    f"output {totals['outputBytes'] / 1024 ** 2:.1f} MB, "
+                    f"shuffle read {totals['shuffleReadBytes'] / 1024 ** 2:.1f} MB, "
+                    f"shuffle write {totals['shuffleWriteBytes'] / 1024 ** 2:.1f} MB, "
+                    f"spill {totals['diskBytesSpilled'] / 1024 ** 2:.1f} MB, "
+                    f"max task skew {skew:.1f}")
+
+    def to_dict(self, spark):
+        """Return the run report: application, cluster settings and tables."""
+        sc = spark.sparkContext
+        settings = ["spark.executor.instances",
+                    "spark.executor.cores",
+                    "spark.executor.memory",
+                    "spark.sql.shuffle.partitions",
+                    "spark.dynamicAllocation.enabled",
+                    ]
+        return {"application_id": sc.applicationId,
+                "started_at": self.started_at.isoformat(timespec="seconds"),
+                "wall_time_s": (datetime.now() - self.started_at).total_seconds(),
+                "default_parallelism": sc.defaultParallelism,
+                "settings": {key: sc.getConf().get(key) for key in settings},
+                "tables": self.tables,
+                }
+
+    def to_html(self, report):
+        """Render a run report as a HTML page."""
+        mb = 1024 ** 2
+        rows = []
+        for record in report["tables"]:
+            totals = record["totals"] or {field: 0 for field
+                                          in stage_metric_fields + ["stages"]}
+            skew = max([stage.get("skew", 0.0) for stage in record["stages"]],
+                       default=0.0)
+            rows.append(
+                "<tr>"
+                f"<td>{html.escape(record['table'])}</td>"
+                f"<td>{record['wall_time_s']:.1f}</td>"
+                f"<td>{totals['stages']}</td>"
+                f"<td>{totals['inputBytes'] / mb:.1f}</td>"
+                f"<td>{totals['outputBytes'] / mb:.1f}</td>"
+                f"<td>{totals['shuffleReadBytes'] / mb:.1f}</td>"
+                f"<td>{totals['shuffleWriteBytes'] / mb:.1f}</td>"
+                f"<td>{totals['memoryBytesSpilled'] / mb:.1f}</td>"
+                f"<td>{totals['diskBytesSpilled'] / mb:.1f}</td>"
+                f"<td>{totals['executorCpuTime'] / 1e9:.1f}</td>"
+                f"<td>{skew:.1f}</td>"
+                "</tr>"
+            )
+        settings = "".join(f"<li>{html.escape(key)}: {html.escape(str(value))}</li>"
+                           for key, value in report["settings"].items())
+        return (
+            "<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\">"
+            f"<title>ETL run {html.escape(report['application_id'])}</title>"
+            "<style>table{border-collapse:collapse}"
+            "td,th{border:1px solid #ccc;padding:4px 8px;text-align:right}"
+            "td:first-child{text-align:left}</style></head><body>"
+            f"<h1>ETL run {html.escape(report['application_id'])}</h1>"
+            f"<p>Started {report['started_at']}, "
+            f"{report['wall_time_s']:.0f} s, "
+            f"default parallelism {report['default_parallelism']}</p>"
+            f"<ul>{settings}</ul>"
+            "<table><tr><th>Table</th><th>Wall time (s)</th><th>Stages</th>"
+            "<th>Input (MB)</th><th>Output (MB)</th>"
+            "<th>Shuffle read (MB)</th><th>Shuffle write (MB)</th>"
+            "<th>Spill memory (MB)</th><th>Spill disk (MB)</th>"
+            "<th>Executor CPU (s)</th><th>Max task skew</th></tr>"
+            f"{''.join(rows)}</table></body></html>\n"
+        )
+
+    def write_report(self, spark, report_dir):
+        """Write the run report as JSON and HTML into report_dir, named by
+        the start time of the run. Return the path of the JSON report.
+        """
+        report = self.to_dict(spark)
+        name = self.started_at.strftime("run_%Y%m%dT%H%M%S")
+        path = f"{report_dir.rstrip('/')}/{name}"
+        hadoop_fs.write_text(spark, f"{path}.json", json.dumps(report, indent=2))
+        hadoop_fs.write_text(spark, f"{path}.html", self.to_html(report))
+        return f"{path}.json"
+
+
+run_metrics = RunMetrics()
@@ -0,0 +1,93 @@
+"""
+Table-level metadata of the parquet tables: row count and min/max per column,
+for the whole table and per file. It is written to `_table_metadata.json` in
+the table directory (ignored by Spark like all paths starting with `_`):
+
+    {"table": "songplays_table",
+     "created_at": "2020-05-01T12:00:00",
+     "rows": 6820,
+     "columns": {"user_id": {"min": "10", "max": "99"}, ...},
+     "files": [{"path": ".../year=2018/month=11/part-00000-...parquet",
+                "rows": 6820,
+                "columns": {"user_id": {"min": "10", "max": "99"}, ...}},
+               ...]}
+
+Readers can prune files with it without opening them, see files_matching.
+Values are stored as strings (timestamps in ISO format), numbers as numbers.
+"""
+
+import json
+import posixpath
+from datetime import datetime
+from pyspark.sql import functions as F
+import hadoop_fs
+
+METADATA_FILE = "_table_metadata.json"
+
+
+def _value(value):
+    """Return a JSON serializable min/max value."""
+    if value is None or isinstance(value, (int, float, str)):
+        return value
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def collect_table_metadata(spark, path, columns):
+    """Return the metadata of a table, with min/max of the given columns
+    (including partition columns). Only these columns are scanned.
+    """
+    df = spark.read.parquet(path).withColumn("_file", F.input_file_name())
+    aggregates = [F.count("*").alias("_rows")]
+    for column in columns:
+        aggregates += [F.min(column).alias(f"_min_{column}"),
+                       F.max(column).alias(f"_max_{column}")]
+    files = []
+    for row in df.groupBy("_file").agg(*aggregates).orderBy("_file").collect():
+        files.append({"path": row["_file"],
+                      "rows": row["_rows"],
+                      "columns": {column: {"min": _value(row[f"_min_{column}"]),
+                                           "max": _value(row[f"_max_{column}"])}
+                                  for column in columns},
+                      })
+
+    table_columns = {}
+    for column in columns:
+        mins = [f["columns"][column]["min"] for f in files
+                if f["columns"][column]["min"] is not None]
+        maxs = [f["columns"][column]["max"] for f in files
+                if f["columns"][column]["max"] is not None]
+        table_columns[column] = {"min": min(mins) if mins else None,
+                                 "max": max(maxs) if maxs else None}
+
+    return {"table": posixpath.basename(path.rstrip("/")).replace(".parquet", ""),
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "rows": sum(f["rows"] for f in files),
+            "columns": table_columns,
+            "files": files,
+            }
+
+
+def write_table_metadata(spark, path, columns):
+    """Collect the metadata of a table and write it into the table directory."""
+    metadata = collect_table_metadata(spark, path, columns)
+    hadoop_fs.write_text(spark, posixpath.join(path.rstrip("/"), METADATA_FILE),
+                         json.dumps(metadata, indent=2))
+    return metadata
+
+
+def read_table_metadata(spark, path):
+    """Return the metadata of a table, None if there is none."""
+    text = hadoop_fs.read_text(spark, posixpath.join(path.rstrip("/"),
+                                                     METADATA_FILE))
+    return json.loads(text) if text else None
+
+
+def files_matching(metadata, column, value):
+    """Return the paths of the files that may contain rows with
+    column == value, i.e. whose min/max range includes the value.
+    """
+    return [f["path"] for f in metadata["files"]
+            if f["columns"][column]["min"] is not None
+            and f["columns"][column]["min"] <= value <= f["columns"][column]["max"]]
@@ -1,12 +1,13 @@
 from datetime import datetime, timedelta
 from airflow import DAG
 from airflow.operators.dummy_operator import DummyOperator
+from airflow.sensors.external_task_sensor import ExternalTaskSensor
 from airflow.operators import (StageToRedshiftOperator,
                                LoadFactOperator,
                                LoadDimensionOperator,
                                DataQualityOperator
                                )
-from helpers import SqlQueries, DataChecks
+from helpers import SqlQueries, DataChecks, TableChecks
 
 # Note: Credentials are set with Airflow Hooks
 # config = configparser.ConfigParser()
@@ -36,6 +37,7 @@ dag = DAG('sparkify_dag',
           )
 
 # Define Tasks
+# The song data (staging_songs, songs and artists) is loaded by sparkify_songs_dag
 
 start_operator = DummyOperator(
     task_id='Begin_execution',
@@ -52,18 +54,21 @@ stage_events_to_redshift = StageToRedshiftOperator(
     s3_bucket="udacity-dend",
     # load data based on execution time only
     s3_key="log_data/{execution_date.year}/{execution_date.month}/{ds}-events.json",
-    json_format="'s3://udacity-dend/log_json_path.json'"
+    json_format="'s3://udacity-dend/log_json_path.json'",
+    # Replace the staged events of the previous run
+    truncate=True
 )
 
-stage_songs_to_redshift = StageToRedshiftOperator(
-    task_id='Stage_songs',
+# The songs of the events are staged by sparkify_songs_dag. Its only run
+# (@once) is at its start date, so every hourly run waits for that run.
+wait_for_songs = ExternalTaskSensor(
+    task_id='Wait_for_songs',
     dag=dag,
-    provide_context=True,  # not necessary here
-    table="staging_songs",
-    redshift_conn_id="redshift",
-    aws_credentials_id="aws_credentials",
-    s3_bucket="udacity-dend",
-    s3_key="song_data/A/A/A/"  # Load only a small subset
+    external_dag_id='sparkify_songs_dag',
+    external_task_id='Stop_execution',
+    execution_date_fn=lambda execution_date: datetime(2018, 11, 1),
+    poke_interval=60,
+    timeout=6 * 60 * 60
 )
 
 load_songplays_table = LoadFactOperator(
@@ -80,25 +85,11 @@ load_user_dimension_table = LoadDimensionOperator(
     redshift_conn_id="redshift",
     destination_table="users",
     sql_statement=SqlQueries.user_table_insert,
-    update_mode="insert"
-)
-
-load_song_dimension_table = LoadDimensionOperator(
-    task_id='Load_song_dim_table',
-    dag=dag,
-    redshift_conn_id="redshift",
-    destination_table="songs",
-    sql_statement=SqlQueries.song_table_insert,
-    update_mode="insert"
-)
-
-load_artist_dimension_table = LoadDimensionOperator(
-    task_id='Load_artist_dim_table',
-    dag=dag,
-    redshift_conn_id="redshift",
-    destination_table="artists",
-    sql_statement=SqlQueries.artist_table_insert,
-    update_mode="insert"
+    update_mode="merge",
+    key_columns=["userid"],
+    # only the events of the execution hour
+    incremental_predicate=("ts >= {{ execution_date.int_timestamp * 1000 }} "
+                           "AND ts < {{ next_execution_date.int_timestamp * 1000 }}")
 )
 
 load_time_dimension_table = LoadDimensionOperator(
@@ -107,7 +98,11 @@ load_time_dimension_table = LoadDimensionOperator(
     redshift_conn_id="redshift",
     destination_table="time",
     sql_statement=SqlQueries.time_table_insert,
-    update_mode="insert"
+    update_mode="merge",
+    key_columns=["start_time"],
+    # only the events of the execution hour
+    incremental_predicate=("start_time >= '{{ execution_date.strftime('%Y-%m-%d %H:%M:%S') }}' "
+                           "AND start_time < '{{ next_execution_date.strftime('%Y-%m-%d %H:%M:%S') }}'")
 )
 
 run_quality_checks = DataQualityOperator(
@@ -119,12 +114,40 @@ run_quality_checks = DataQualityOperator(
                     DataChecks.empty_table_check,
                     DataChecks.songplay_id_check,
                     ],
-    table=["staging_events",
-           "staging_songs",
-           "songplays",
-           "",
-           ],
-    expected_result=[1, 1, 1, 1]
+    table_list=["staging_events",
+                "staging_songs",
+                "songplays",
+                "",
+                ],
+    expected_results=[1, 1, 1, 1],
+    # all checks in one UNION ALL query
+    check_mode="union",
+    # one aggregate scan per table, metric values recorded per run
+    table_checks=[
+        (TableChecks("songplays")
+         .row_count(min_rows=1)
+         # rows loaded for the execution hour, compared to the last runs
+         .window_row_count("start_time",
+                           "TIMESTAMP '{execution_date:%Y-%m-%d %H:%M:%S}'",
+                           "TIMESTAMP '{next_execution_date:%Y-%m-%d %H:%M:%S}'",
+                           anomaly=True)
+         .null_ratio("userid", max_ratio=0.0)
+         .unique("playid")
+         .references("userid", "users", "userid")
+         .references("songid", "songs", "songid")
+         .references("artistid", "artists", "artistid")
+         .references("start_time", "time", "start_time")
+         .freshness("start_time", max_age_hours=24,
+                    reference="TIMESTAMP '{next_execution_date:%Y-%m-%d %H:%M:%S}'")),
+        (TableChecks("users")
+         .row_count(min_rows=1)
+         .unique("userid")
+         .null_ratio("level", max_ratio=0.0)),
+    ],
+    history_table="dq_metric_history",
+    # hourly play counts are small, allow at least 20 % or 10 rows off the mean
+    anomaly_min_rel_tolerance=0.2,
+    anomaly_min_abs_tolerance=10
 )
 
 end_operator = DummyOperator(
@@ -135,15 +158,11 @@ end_operator = DummyOperator(
 # Define dependencies
 
 start_operator >> stage_events_to_redshift
-start_operator >> stage_songs_to_redshift
 stage_events_to_redshift >> load_songplays_table
-stage_songs_to_redshift >> load_songplays_table
-load_songplays_table >> load_song_dimension_table
+start_operator >> wait_for_songs
+wait_for_songs >> load_songplays_table
 load_songplays_table >> load_user_dimension_table
-load_songplays_table >> load_artist_dimension_table
 load_songplays_table >> load_time_dimension_table
-load_song_dimension_table >> run_quality_checks
 load_user_dimension_table >> run_quality_checks
-load_artist_dimension_table >> run_quality_checks
 load_time_dimension_table >> run_quality_checks
 run_quality_checks >> end_operator
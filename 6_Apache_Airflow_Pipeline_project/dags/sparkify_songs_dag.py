@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+from airflow import DAG
+from airflow.operators.dummy_operator import DummyOperator
+from airflow.operators import (StageToRedshiftOperator,
+                               LoadDimensionOperator
+                               )
+from helpers import SqlQueries
+
+# Stage the song data once, not in every hourly run of sparkify_dag. Trigger
+# it again from the Airflow UI when the song data changes.
+
+# Define DAG
+
+default_args = {
+    "owner": "rbuerki",
+    "depends_on_past": False,
+    # sparkify_dag waits for the run at this date
+    'start_date': datetime(2018, 11, 1),
+    "retries": 5,
+    "retry_delay": timedelta(minutes=5),
+    "catchup": False,
+    'email': ['airflow@example.com'],
+    'email_on_failure': False,
+    'email_on_retry': False,
+}
+
+dag = DAG('sparkify_songs_dag',
+          default_args=default_args,
+          description='Stage the song data and load songs and artists in Redshift',
+          schedule_interval='@once'
+          )
+
+# Define Tasks
+
+start_operator = DummyOperator(
+    task_id='Begin_execution',
+    dag=dag
+)
+
+stage_songs_to_redshift = StageToRedshiftOperator(
+    task_id='Stage_songs',
+    dag=dag,
+    provide_context=True,  # not necessary here
+    table="staging_songs",
+    redshift_conn_id="redshift",
+    aws_credentials_id="aws_credentials",
+    s3_bucket="udacity-dend",
+    # Load the full tree, listed into a manifest for a parallel COPY
+    s3_key="song_data/",
+    use_manifest=True,
+    manifest_bucket="sparkify-airflow-manifests",
+    # Replace the staged songs instead of appending them again
+    truncate=True
+)
+
+load_song_dimension_table = LoadDimensionOperator(
+    task_id='Load_song_dim_table',
+    dag=dag,
+    redshift_conn_id="redshift",
+    destination_table="songs",
+    sql_statement=SqlQueries.song_table_insert,
+    update_mode="merge",
+    key_columns=["songid"]
+)
+
+load_artist_dimension_table = LoadDimensionOperator(
+    task_id='Load_artist_dim_table',
+    dag=dag,
+    redshift_conn_id="redshift",
+    destination_table="artists",
+    sql_statement=SqlQueries.artist_table_insert,
+    update_mode="merge",
+    key_columns=["artistid"]
+)
+
+end_operator = DummyOperator(
+    task_id='Stop_execution',
+    dag=dag
+)
+
+# Define dependencies
+
+start_operator >> stage_songs_to_redshift
+stage_songs_to_redshift >> load_song_dimension_table
+stage_songs_to_redshift >> load_artist_dimension_table
+load_song_dimension_table >> end_operator
+load_artist_dimension_table >> end_operator
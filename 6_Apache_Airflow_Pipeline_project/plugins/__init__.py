@@ -15,5 +15,6 @@ class SparkifyPlugin(AirflowPlugin):
     helpers = [
         helpers.SqlQueries,
         helpers.DataChecks,
+        helpers.TableChecks,
     ]
 
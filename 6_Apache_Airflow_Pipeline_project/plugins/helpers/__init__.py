@@ -1,8 +1,9 @@
 
 from helpers.sql_queries import SqlQueries
-from helpers.data_checks import DataChecks
+from helpers.data_checks import DataChecks, TableChecks
 
 __all__ = [
     'SqlQueries',
-    'DataChecks'
+    'DataChecks',
+    'TableChecks'
 ]
@@ -1,3 +1,7 @@
+import math
+from collections import namedtuple
+
+
 class DataChecks:
     """Store data quality check statements and expected results."""
 
@@ -11,11 +15,161 @@ class DataChecks:
 
     songplay_id_check = """
         SELECT
-            MAX(total.songplay_id_count) AS max_count
+            MAX(total.playid_count) AS max_count
         FROM (SELECT
-                COUNT(songplay_id) as songplay_id_count
+                COUNT(playid) as playid_count
               FROM songplays
-              GROUP BY songplay_id) total
+              GROUP BY playid) total
     """
 
     songplay_id_check_expected_result = 1
+
+    # Mean, standard deviation and number of the last {runs} passed values
+    # of the metrics of the tables, to derive anomaly thresholds
+    metric_history_stats = """
+        SELECT table_name, metric, AVG(value), STDDEV_SAMP(value), COUNT(*)
+        FROM (SELECT table_name, metric, value,
+                     ROW_NUMBER() OVER (PARTITION BY table_name, metric
+                                        ORDER BY recorded_at DESC) AS run_rank
+              FROM {history_table}
+              WHERE table_name IN ({tables})
+                  AND passed
+                  AND recorded_at < '{recorded_at}') history
+        WHERE run_rank <= {runs}
+        GROUP BY table_name, metric
+    """
+
+    metric_history_delete = """
+        DELETE FROM {history_table}
+        WHERE table_name IN ({tables})
+            AND recorded_at = '{recorded_at}'
+    """
+
+    metric_history_insert = """
+        INSERT INTO {history_table} (table_name, metric, value, passed, recorded_at)
+        VALUES {values}
+    """
+
+
+# A metric of a table: SQL aggregate expression and thresholds. If anomaly
+# is True, the thresholds are narrowed to a band around the mean of the
+# historical values (see TableChecks.thresholds).
+Metric = namedtuple("Metric", ["name", "expression", "min_value", "max_value",
+                               "anomaly"])
+
+
+class TableChecks:
+    """Declarative data quality checks of a table, compiled into a single
+    aggregate scan of the table:
+
+        checks = (TableChecks("songplays")
+                  .row_count(min_rows=1)
+                  .window_row_count("start_time", "'{window_start}'",
+                                    "'{window_end}'", anomaly=True)
+                  .null_ratio("userid", max_ratio=0.0)
+                  .unique("playid")
+                  .references("userid", "users", "userid")
+                  .freshness("start_time", max_age_hours=24))
+        checks.sql()  # SELECT COUNT(*) AS row_count, ... FROM songplays t ...
+
+    Referential integrity checks join the distinct keys of the referenced
+    table, so the row counts of the table are not changed.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.metrics = []
+        self.joins = []
+
+    def add_metric(self, name, expression, min_value=None, max_value=None,
+                   anomaly=False):
+        self.metrics.append(Metric(name, expression, min_value, max_value,
+                                   anomaly))
+        return self
+
+    def row_count(self, min_rows=1, max_rows=None, anomaly=False):
+        """Check the number of rows."""
+        return self.add_metric("row_count", "COUNT(*)", min_rows, max_rows,
+                               anomaly)
+
+    def window_row_count(self, column, window_start, window_end, min_rows=0,
+                         max_rows=None, anomaly=False):
+        """Check the number of rows with a timestamp column in a window
+        (SQL expressions, end excluded), e.g. the rows loaded by a run. Unlike
+        the cumulative row count, it is comparable between runs.
+        """
+        return self.add_metric(
+            f"window_rows_{column}",
+            f"COALESCE(SUM(CASE WHEN t.{column} >= {window_start}"
+            f" AND t.{column} < {window_end} THEN 1 ELSE 0 END), 0)",
+            min_rows, max_rows, anomaly)
+
+    def null_ratio(self, column, max_ratio=0.0, anomaly=False):
+        """Check the ratio of NULL values of a column."""
+        return self.add_metric(
+            f"null_ratio_{column}",
+            f"CAST(SUM(CASE WHEN t.{column} IS NULL THEN 1 ELSE 0 END) AS FLOAT8)"
+            f" / NULLIF(COUNT(*), 0)",
+            0.0, max_ratio, anomaly)
+
+    def unique(self, column):
+        """Check that the non-NULL values of a column are unique."""
+        return self.add_metric(f"duplicates_{column}",
+                               f"COUNT(t.{column}) - COUNT(DISTINCT t.{column})",
+                               0, 0)
+
+    def references(self, column, ref_table, ref_column):
+        """Check that all non-NULL values of a column exist in the column of
+        another table, e.g. songplays.userid in users.userid.
+        """
+        alias = f"ref_{len(self.joins)}"
+        self.joins.append(
+            f"LEFT JOIN (SELECT DISTINCT {ref_column} AS ref_key FROM {ref_table}) {alias}"
+            f" ON t.{column} = {alias}.ref_key")
+        return self.add_metric(
+            f"orphans_{column}",
+            f"SUM(CASE WHEN t.{column} IS NOT NULL AND {alias}.ref_key IS NULL"
+            f" THEN 1 ELSE 0 END)",
+            0, 0)
+
+    def freshness(self, column, max_age_hours, reference="GETDATE()"):
+        """Check the hours between the latest timestamp of a column and a
+        reference time (SQL expression, default: now).
+        """
+        return self.add_metric(f"age_hours_{column}",
+                               f"DATEDIFF(hour, MAX(t.{column}), {reference})",
+                               None, max_age_hours)
+
+    def sql(self):
+        """Return the query computing all metrics in one scan of the table."""
+        expressions = ",\n    ".join(f"{metric.expression} AS {metric.name}"
+                                     for metric in self.metrics)
+        joins = "".join(f"\n{join}" for join in self.joins)
+        return f"SELECT\n    {expressions}\nFROM {self.table} t{joins}"
+
+    @staticmethod
+    def thresholds(metric, stats=None, sigma=3.0, min_runs=5,
+                   min_rel_tolerance=0.0, min_abs_tolerance=0.0):
+        """Return the (min, max) thresholds of a metric. For anomaly metrics
+        with at least min_runs historical values (mean, stddev, count), they
+        are narrowed to mean +/- sigma standard deviations, but to no less
+        than mean +/- min_rel_tolerance * |mean| and mean +/- min_abs_tolerance.
+        The history only holds passed values, so without a tolerance a
+        constant metric (stddev 0) would fail on any change, and keep failing.
+        """
+        low, high = metric.min_value, metric.max_value
+        if metric.anomaly and stats and stats[2] >= min_runs:
+            mean, stddev = float(stats[0]), float(stats[1] or 0.0)
+            band = max(sigma * stddev, min_rel_tolerance * abs(mean),
+                       min_abs_tolerance)
+            low = mean - band if low is None else max(low, mean - band)
+            high = mean + band if high is None else min(high, mean + band)
+        return low, high
+
+    @staticmethod
+    def passes(value, low, high):
+        """Return True if a value is within the thresholds (None: unbounded)."""
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            return False
+        return ((low is None or float(value) >= low)
+                and (high is None or float(value) <= high))
@@ -2,6 +2,8 @@ class SqlQueries:
 
     """Store SQL statements for DAG"""
 
+    # Staged rows are deduplicated before the join: each event once, and one
+    # song per (title, artist_name, duration), so the playids are unique
     songplay_table_insert = ("""
         SELECT
                 md5(song_id || CAST(events.start_time as VARCHAR) || nvl(CAST(events.userid as VARCHAR), '-9999')) as songplay_id,
@@ -13,12 +15,20 @@ class SqlQueries:
                 events.sessionid, 
                 events.location, 
                 events.useragent
-                FROM (SELECT TIMESTAMP 'epoch' + ts/1000 * interval '1 second' AS start_time, *
+                FROM (SELECT DISTINCT TIMESTAMP 'epoch' + ts/1000 * interval '1 second' AS start_time, *
             FROM staging_events
             WHERE page='NextSong'
+                AND ts >= DATEDIFF(ms, TIMESTAMP 'epoch', TIMESTAMP '{window_start}')
+                AND ts < DATEDIFF(ms, TIMESTAMP 'epoch', TIMESTAMP '{window_end}')
                 ) events
 
-            LEFT JOIN staging_songs songs
+            LEFT JOIN (SELECT song_id, artist_id, title, artist_name, duration
+                FROM (SELECT song_id, artist_id, title, artist_name, duration,
+                             ROW_NUMBER() OVER (PARTITION BY title, artist_name, duration
+                                                ORDER BY song_id) AS song_rank
+                    FROM staging_songs) ranked
+                WHERE song_rank = 1
+                ) songs
             ON events.song = songs.title
                 AND events.artist = songs.artist_name
                 AND events.length = songs.duration
@@ -26,29 +36,43 @@ class SqlQueries:
                 AND song_id IS NOT NULL
     """)
 
+    # The dimension queries return one row per key, as needed for a merge,
+    # and contain the {incremental_predicate} of the LoadDimensionOperator
     user_table_insert = ("""
-        SELECT distinct userid, firstname, lastname, gender, level
-        FROM staging_events
-        WHERE page='NextSong'
-            AND userid IS NOT NULL
+        SELECT userid, firstname, lastname, gender, level
+        FROM (SELECT userid, firstname, lastname, gender, level,
+                     ROW_NUMBER() OVER (PARTITION BY userid ORDER BY ts DESC) AS event_rank
+            FROM staging_events
+            WHERE page='NextSong'
+                AND userid IS NOT NULL
+                AND {incremental_predicate}
+                ) events
+        WHERE event_rank = 1
     """)
 
     song_table_insert = ("""
         SELECT distinct song_id, title, artist_id, year, duration
         FROM staging_songs
         WHERE song_id IS NOT NULL
+            AND {incremental_predicate}
     """)
 
     artist_table_insert = ("""
-        SELECT distinct artist_id, artist_name, artist_location, artist_latitude, artist_longitude
-        FROM staging_songs
-        WHERE artist_id IS NOT NULL
+        SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude
+        FROM (SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude,
+                     ROW_NUMBER() OVER (PARTITION BY artist_id ORDER BY artist_name) AS artist_rank
+            FROM staging_songs
+            WHERE artist_id IS NOT NULL
+                AND {incremental_predicate}
+                ) artists
+        WHERE artist_rank = 1
     """)
 
     time_table_insert = ("""
-        SELECT start_time, extract(hour from start_time), extract(day from start_time), extract(week from start_time), 
+        SELECT distinct start_time, extract(hour from start_time), extract(day from start_time), extract(week from start_time), 
                extract(month from start_time), extract(year from start_time), extract(dayofweek from start_time)
         FROM songplays
         WHERE start_time IS NOT NULL
+            AND {incremental_predicate}
     """)
  
\ No newline at end of file
@@ -1,21 +1,49 @@
+import time
+from multiprocessing.pool import ThreadPool
 from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
+from helpers import DataChecks
 
 
 class DataQualityOperator(BaseOperator):
     """Run data quality checks on one or more tables.
 
+    Every check query returns a single value, which is compared to the
+    expected result. The value, the expected result and the duration of each
+    check are logged and returned (pushed to XCom).
+
     Parameters:
     -----------
     - redshift_conn_id: Conn Id of the Airflow connection to redshift database
     - sql_query_list: A list of one or more queries to check data.
     - table_list: A list of one or more tables for the data check queries.
     - expected_results: A list of expected results for each data check query.
+    - check_mode (optional): 'union', 'sequential' or 'concurrent'. 'union'
+        combines all checks into one UNION ALL query, i.e. one round trip.
+        'sequential' runs the checks one after the other. Both run on the
+        connection shared with the table checks. 'concurrent' runs them in
+        parallel on max_workers connections of their own.
+        Defaults to 'union'
+    - max_workers (optional): number of connections for 'concurrent', defaults to 4
+    - table_checks (optional): A list of TableChecks, each run as one aggregate
+        scan of its table on the shared connection. Their SQL is formatted
+        with the task context, e.g. for a freshness reference "TIMESTAMP '{next_execution_date:%Y-%m-%d %H:%M:%S}'"
+    - history_table (optional): table recording the metric values of the
+        table checks per execution date. If set, the thresholds of anomaly
+        metrics are derived from the last history_runs passed values. The
+        history of all tables is read and written once per run
+    - history_runs (optional): number of runs for anomaly thresholds, defaults to 30
+    - anomaly_sigma (optional): allowed standard deviations from the
+        historical mean of anomaly metrics, defaults to 3.0
+    - anomaly_min_rel_tolerance (optional): minimum allowed deviation from the
+        historical mean of anomaly metrics, relative to the mean, defaults to 0.1
+    - anomaly_min_abs_tolerance (optional): minimum allowed absolute deviation
+        from the historical mean of anomaly metrics, defaults to 0.0
 
     Returns:
     --------
-        - Exception raised on data check failure.
+        - List of check results. Exception raised on data check failure.
     """
     ui_color = '#89DA59'
 
@@ -25,25 +53,183 @@ class DataQualityOperator(BaseOperator):
                  sql_query_list=None,
                  table_list=None,
                  expected_results=None,
+                 check_mode="union",
+                 max_workers=4,
+                 table_checks=None,
+                 history_table="",
+                 history_runs=30,
+                 anomaly_sigma=3.0,
+                 anomaly_min_rel_tolerance=0.1,
+                 anomaly_min_abs_tolerance=0.0,
                  *args, **kwargs):
 
         super(DataQualityOperator, self).__init__(*args, **kwargs)
         self.redshift_conn_id=redshift_conn_id
-        self.sql_query_list=sql_query_list
-        self.tableList=table_list
-        self.expected_results=expected_results
+        self.sql_query_list=sql_query_list or []
+        self.table_list=table_list or []
+        self.expected_results=expected_results or []
+        self.check_mode=check_mode
+        self.max_workers=max_workers
+        self.table_checks=table_checks or []
+        self.history_table=history_table
+        self.history_runs=history_runs
+        self.anomaly_sigma=anomaly_sigma
+        self.anomaly_min_rel_tolerance=anomaly_min_rel_tolerance
+        self.anomaly_min_abs_tolerance=anomaly_min_abs_tolerance
+
+        if not (len(self.sql_query_list) == len(self.table_list)
+                == len(self.expected_results)):
+            raise ValueError("sql_query_list, table_list and expected_results "
+                             "must have the same length.")
+        if check_mode not in ("union", "sequential", "concurrent"):
+            raise ValueError(f"Unknown check_mode {check_mode}.")
+
+    @staticmethod
+    def union_query(queries):
+        """Return one query returning (check index, value) of all check queries."""
+        return "\nUNION ALL\n".join(f"SELECT {index} AS check_index, ({query.strip()}) AS value"
+                                    for index, query in enumerate(queries))
+
+    def run_union(self, cursor, queries):
+        start = time.perf_counter()
+        cursor.execute(self.union_query(queries))
+        seconds = time.perf_counter() - start
+        values = dict(cursor.fetchall())
+        # One round trip, so all checks share its duration
+        return [(values.get(index), seconds) for index in range(len(queries))]
+
+    def run_sequential(self, cursor, queries):
+        results = []
+        for query in queries:
+            start = time.perf_counter()
+            cursor.execute(query)
+            row = cursor.fetchone()
+            results.append((row[0] if row else None,
+                            time.perf_counter() - start))
+        return results
+
+    def run_concurrent(self, redshift, queries):
+        def run_check(query):
+            start = time.perf_counter()
+            row = redshift.get_first(query)
+            return (row[0] if row else None, time.perf_counter() - start)
+
+        with ThreadPool(min(self.max_workers, len(queries))) as pool:
+            return pool.map(run_check, queries)
+
+    def run_query_checks(self, redshift, cursor):
+        """Run the check queries and return their results. 'union' and
+        'sequential' run on the cursor, 'concurrent' on connections of its own.
+        """
+        queries = [query.format(table)
+                   for query, table in zip(self.sql_query_list, self.table_list)]
+
+        start = time.perf_counter()
+        if self.check_mode == "concurrent":
+            values = self.run_concurrent(redshift, queries)
+        else:
+            values = getattr(self, f"run_{self.check_mode}")(cursor, queries)
+        self.log.info(f"Ran {len(queries)} data quality checks ({self.check_mode}) "
+                      f"in {time.perf_counter() - start:.2f} s")
+
+        return [{"check": index,
+                 "table": table,
+                 "value": value,
+                 "expected": expected,
+                 "seconds": round(seconds, 3),
+                 "passed": value == expected,
+                 }
+                for index, ((value, seconds), table, expected) in enumerate(
+                    zip(values, self.table_list, self.expected_results))]
+
+    def history_params(self, recorded_at):
+        tables = sorted({checks.table for checks in self.table_checks})
+        return dict(history_table=self.history_table,
+                    tables=", ".join(f"'{table}'" for table in tables),
+                    recorded_at=recorded_at)
+
+    def read_history(self, cursor, recorded_at):
+        """Return the history stats (mean, stddev, count) of the metrics of
+        all table checks by (table, metric), read in one query.
+        """
+        cursor.execute(DataChecks.metric_history_stats.format(
+            runs=self.history_runs, **self.history_params(recorded_at)))
+        return {(record[0], record[1]): record[2:] for record in cursor.fetchall()}
+
+    def write_history(self, cursor, results, recorded_at):
+        """Replace the metric values of the execution date, e.g. of a rerun,
+        with the values of this run.
+        """
+        values = ", ".join(
+            f"('{result['table']}', '{result['check']}', "
+            f"{'NULL' if result['value'] is None else result['value']}, "
+            f"{'TRUE' if result['passed'] else 'FALSE'}, '{recorded_at}')"
+            for result in results)
+        params = self.history_params(recorded_at)
+        cursor.execute(DataChecks.metric_history_delete.format(**params))
+        cursor.execute(DataChecks.metric_history_insert.format(values=values,
+                                                               **params))
+
+    def run_table_checks(self, cursor, context):
+        """Compute the metrics of every TableChecks in one scan of its table,
+        compare them to their thresholds and record them in the history table.
+        """
+        recorded_at = context["execution_date"].strftime("%Y-%m-%d %H:%M:%S")
+        history = self.read_history(cursor, recorded_at) if self.history_table else {}
+
+        results = []
+        for checks in self.table_checks:
+            start = time.perf_counter()
+            cursor.execute(checks.sql().format(**context))
+            row = cursor.fetchone()
+            seconds = time.perf_counter() - start
+
+            for metric, value in zip(checks.metrics, row):
+                low, high = checks.thresholds(
+                    metric, history.get((checks.table, metric.name)),
+                    self.anomaly_sigma,
+                    min_rel_tolerance=self.anomaly_min_rel_tolerance,
+                    min_abs_tolerance=self.anomaly_min_abs_tolerance)
+                results.append({"check": metric.name,
+                                "table": checks.table,
+                                "value": float(value) if value is not None else None,
+                                "expected": [low, high],
+                                "seconds": round(seconds, 3),
+                                "passed": checks.passes(value, low, high),
+                                })
+
+        if self.history_table:
+            self.write_history(cursor, results, recorded_at)
+        return results
 
     def execute(self, context):
-        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
+        if not self.sql_query_list and not self.table_checks:
+            self.log.info("No data quality checks to run.")
+            return []
 
-        self.log.info('DataQualityOperator not implemented yet')
+        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
+        # The checks, the history reads and the history writes share one
+        # connection, the history writes are committed together at the end
+        conn = redshift.get_conn()
+        try:
+            cursor = conn.cursor()
+            results = self.run_query_checks(redshift, cursor) if self.sql_query_list else []
+            if self.table_checks:
+                results += self.run_table_checks(cursor, context)
+            conn.commit()
+            cursor.close()
+        finally:
+            conn.close()
 
-        checks = zip(self.data_check_query, self.table, self.expected_result)
+        for result in results:
+            self.log.info(f"Check {result['check']} on {result['table'] or '-'}: "
+                          f"value {result['value']}, expected {result['expected']}, "
+                          f"{result['seconds']:.2f} s, "
+                          f"{'passed' if result['passed'] else 'FAILED'}")
 
-        for check in checks:
-            try:
-                redshift.run(check[0].format(check[1])) == check[2]
-                self.log.info('Data quality check passed.')
-            except:
-                self.log.info('Data quality check failed.')
-                raise AssertionError('Data quality check failed.')
+        failed = [result for result in results if not result["passed"]]
+        if failed:
+            raise ValueError(f"{len(failed)} of {len(results)} data quality "
+                             f"checks failed: {failed}")
+        self.log.info('All data quality checks passed.')
+        return results
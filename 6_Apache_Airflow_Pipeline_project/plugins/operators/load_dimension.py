@@ -10,9 +10,19 @@ class LoadDimensionOperator(BaseOperator):
     -----------
     - redshift_conn_id: Conn Id of the Airflow connection to redshift database
     - destination_table: name of the fact table to update
-    - sql_statement: 'SELECT' query to retrieve rows for insertion in fact table
-    - update_mode (optional): 'insert' or 'overwrite'. 'overwrite' truncates destination
-        table before inserting rows. Defaults to 'overwrite'
+    - sql_statement: 'SELECT' query to retrieve rows for insertion in fact table.
+        It may contain the placeholder {incremental_predicate}
+    - update_mode (optional): 'insert', 'overwrite' or 'merge'. 'overwrite' truncates
+        destination table before inserting rows. 'merge' stages the rows in a
+        temp table, deletes the rows with matching key_columns from the
+        destination table and inserts the staged rows, in one transaction.
+        Defaults to 'overwrite'
+    - key_columns (optional): list of the key columns of the destination table,
+        required for 'merge'
+    - incremental_predicate (optional): SQL condition on the source tables that
+        replaces {incremental_predicate} in sql_statement, e.g. to select only the
+        events of the execution hour. Templated, e.g.
+        "ts >= {{ execution_date.int_timestamp * 1000 }}". Defaults to TRUE
 
     Returns:
     --------
@@ -20,6 +30,7 @@ class LoadDimensionOperator(BaseOperator):
 
     """
     ui_color = '#80BD9E'
+    template_fields = ("incremental_predicate", )
 
     @apply_defaults
     def __init__(self,
@@ -27,6 +38,8 @@ class LoadDimensionOperator(BaseOperator):
                  destination_table="",
                  sql_statement="",
                  update_mode="overwrite",
+                 key_columns=None,
+                 incremental_predicate="",
                  *args, **kwargs):
 
         super(LoadDimensionOperator, self).__init__(*args, **kwargs)
@@ -34,10 +47,42 @@ class LoadDimensionOperator(BaseOperator):
         self.destination_table=destination_table
         self.sql_statement=sql_statement
         self.update_mode=update_mode
+        self.key_columns=key_columns or []
+        self.incremental_predicate=incremental_predicate
+
+        if update_mode not in ("insert", "overwrite", "merge"):
+            raise ValueError(f"Unknown update_mode {update_mode}.")
+        if update_mode == "merge" and not self.key_columns:
+            raise ValueError("key_columns are required for update_mode 'merge'.")
+
+    def merge_statements(self, select_query):
+        """Return the statements merging the rows of a SELECT query into the
+        destination table, matching rows by key_columns.
+        """
+        stage = f"stage_{self.destination_table}"
+        key_match = " AND ".join(f'"{self.destination_table}".{column} = {stage}.{column}'
+                                 for column in self.key_columns)
+        return [
+            f'CREATE TEMP TABLE {stage} (LIKE "{self.destination_table}");',
+            f"INSERT INTO {stage} {select_query};",
+            f'DELETE FROM "{self.destination_table}" USING {stage} WHERE {key_match};',
+            f'INSERT INTO "{self.destination_table}" SELECT * FROM {stage};',
+            f"DROP TABLE {stage};",
+        ]
 
     def execute(self, context):
         redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        sql_query = f"INSERT INTO {self.destination_table} {self.sql_statement}"
+        select_query = self.sql_statement.format(
+            incremental_predicate=self.incremental_predicate or "TRUE"
+        )
+
+        if self.update_mode == "merge":
+            self.log.info(f"Merging data into {self.destination_table} "
+                          f"on {', '.join(self.key_columns)}")
+            redshift.run(self.merge_statements(select_query), autocommit=False)
+            return
+
+        sql_query = f"INSERT INTO {self.destination_table} {select_query}"
         if self.update_mode == "overwrite":
             sql_query = f"TRUNCATE {self.destination_table}; {sql_query}"
 
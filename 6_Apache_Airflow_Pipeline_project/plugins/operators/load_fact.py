@@ -4,13 +4,24 @@ from airflow.utils.decorators import apply_defaults
 
 
 class LoadFactOperator(BaseOperator):
-    """Load data into fact table from staging tables.
+    """Load data into fact table from staging tables for a time window.
 
     Parameters:
     -----------
     - redshift_conn_id: Conn Id of the Airflow connection to redshift database
     - destination_table: name of the fact table to update
-    - sql_statement: 'SELECT' query to retrieve rows for insertion in fact table
+    - sql_statement: 'SELECT' query to retrieve rows for insertion in fact table.
+        It has to restrict the staging scan to the window with the placeholders
+        {window_start} and {window_end} (timestamps, end excluded)
+    - window_start (optional): start of the window as 'YYYY-MM-DD HH:MM:SS'.
+        Templated, defaults to the execution date
+    - window_end (optional): end of the window, templated, defaults to the
+        next execution date
+    - time_column (optional): timestamp column of the fact table, defaults to
+        "start_time"
+    - delete_window (optional): if True, delete the rows of the window from the
+        fact table before inserting, in the same transaction. This makes reruns
+        and backfills idempotent. Defaults to True
 
     Returns:
     --------
@@ -18,22 +29,40 @@ class LoadFactOperator(BaseOperator):
 
     """
     ui_color = '#F98866'
+    template_fields = ("window_start", "window_end")
 
     @apply_defaults
     def __init__(self,
                  redshift_conn_id="",
                  destination_table="",
                  sql_statement="",
+                 window_start="{{ execution_date.strftime('%Y-%m-%d %H:%M:%S') }}",
+                 window_end="{{ next_execution_date.strftime('%Y-%m-%d %H:%M:%S') }}",
+                 time_column="start_time",
+                 delete_window=True,
                  *args, **kwargs):
 
         super(LoadFactOperator, self).__init__(*args, **kwargs)
         self.redshift_conn_id=redshift_conn_id
         self.destination_table=destination_table
         self.sql_statement=sql_statement
+        self.window_start=window_start
+        self.window_end=window_end
+        self.time_column=time_column
+        self.delete_window=delete_window
 
     def execute(self, context):
         redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        sql_query = f"INSERT INTO {self.destination_table} {self.sql_statement}"
+        select_query = self.sql_statement.format(window_start=self.window_start,
+                                                 window_end=self.window_end)
+        sql_query = [f"INSERT INTO {self.destination_table} {select_query};"]
+        if self.delete_window:
+            sql_query.insert(0, f"""
+                DELETE FROM {self.destination_table}
+                WHERE {self.time_column} >= '{self.window_start}'
+                    AND {self.time_column} < '{self.window_end}';
+                """)
 
-        self.log.info('Loading data into fact table')
-        redshift.run(sql_query)
+        self.log.info(f"Loading data into fact table from {self.window_start} "
+                      f"to {self.window_end}")
+        redshift.run(sql_query, autocommit=False)
@@ -1,5 +1,7 @@
+import json
 from airflow.contrib.hooks.aws_hook import AwsHook
 from airflow.hooks.postgres_hook import PostgresHook
+from airflow.hooks.S3_hook import S3Hook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
@@ -15,12 +17,23 @@ class StageToRedshiftOperator(BaseOperator):
     - s3_bucket: name of S3 bucket, e.g. "udacity-dend"
     - s3_key: name of S3 key. This field is templatable when context is enabled
     - json_format (optional): path to JSONpaths file, defaults to "auto"
+    - use_manifest (optional): if True, list the objects below the rendered key
+        and COPY them with a manifest file instead of the key prefix. Redshift
+        loads the files of a manifest in parallel across all slices, so whole
+        trees like "song_data/" can be staged. Defaults to False
+    - manifest_bucket (optional): name of the S3 bucket the manifest is written
+        to, required with use_manifest
+    - manifest_key (optional): S3 key of the manifest, templatable like s3_key.
+        Defaults to "manifests/{table}/{ts_nodash}.manifest"
+    - truncate (optional): if True, truncate the staging table before the COPY,
+        in the same transaction, so the table holds only the staged files.
+        Defaults to False
 
     Returns: None
 
     """
     ui_color = '#358140'
-    template_fields = ("s3_key", )
+    template_fields = ("s3_key", "manifest_key")
 
     @apply_defaults
     def __init__(self,
@@ -30,6 +43,10 @@ class StageToRedshiftOperator(BaseOperator):
                  s3_bucket="",
                  s3_key="",
                  json_format="'auto'",
+                 use_manifest=False,
+                 manifest_bucket="",
+                 manifest_key="manifests/{table}/{ts_nodash}.manifest",
+                 truncate=False,
                  *args, **kwargs):
 
         super(StageToRedshiftOperator, self).__init__(*args, **kwargs)
@@ -39,25 +56,84 @@ class StageToRedshiftOperator(BaseOperator):
         self.s3_bucket = s3_bucket
         self.s3_key = s3_key
         self.json_format = json_format
+        self.use_manifest = use_manifest
+        self.manifest_bucket = manifest_bucket
+        self.manifest_key = manifest_key
+        self.truncate = truncate
 
-    def execute(self, context):
-        aws_hook = AwsHook(self.aws_credentials_id)
-        credentials = aws_hook.get_credentials()
-        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        # Set S3 path based on rendered key
-        rendered_key = self.s3_key.format(**context)
-        s3_path = "s3://{}/{}".format(self.s3_bucket, rendered_key)
+        if use_manifest and not manifest_bucket:
+            raise ValueError("manifest_bucket is required with use_manifest.")
+
+    @staticmethod
+    def list_objects(s3, bucket, prefix):
+        """Return (key, size) of all non-empty objects below a key prefix."""
+        paginator = s3.get_conn().get_paginator("list_objects_v2")
+        objects = []
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                if obj["Size"] > 0:
+                    objects.append((obj["Key"], obj["Size"]))
+        return objects
+
+    @staticmethod
+    def build_manifest(bucket, objects):
+        """Return a Redshift COPY manifest (JSON) listing S3 objects."""
+        entries = [{"url": f"s3://{bucket}/{key}",
+                    "mandatory": True,
+                    "meta": {"content_length": size}}
+                   for key, size in objects]
+        return json.dumps({"entries": entries})
+
+    def write_manifest(self, rendered_key, manifest_key):
+        """List the objects below the rendered key, write the manifest to S3
+        and return its path.
+        """
+        s3 = S3Hook(aws_conn_id=self.aws_credentials_id)
+        objects = self.list_objects(s3, self.s3_bucket, rendered_key)
+        if not objects:
+            raise ValueError(f"No objects found in s3://{self.s3_bucket}/{rendered_key}")
 
-        sql_staging = f"""
+        total_mb = sum(size for _, size in objects) / 1024 ** 2
+        self.log.info(f"Listed {len(objects)} objects, {total_mb:.1f} MB")
+        s3.load_string(self.build_manifest(self.s3_bucket, objects),
+                       key=manifest_key,
+                       bucket_name=self.manifest_bucket,
+                       replace=True)
+        return "s3://{}/{}".format(self.manifest_bucket, manifest_key)
+
+    def copy_statements(self, s3_path, credentials):
+        """Return the statements loading the staging table from an S3 path
+        (a key prefix or, with use_manifest, the manifest).
+        """
+        manifest_option = "MANIFEST" if self.use_manifest else ""
+        statements = [f"""
             COPY {self.table}
             FROM '{s3_path}'
             ACCESS_KEY_ID '{credentials.access_key}'
             SECRET_ACCESS_KEY '{credentials.secret_key}'
+            {manifest_option}
             TIMEFORMAT as 'epochmillisecs'
             TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL
             REGION 'us-west-2'
             FORMAT AS JSON {self.json_format};
-            """
+            """]
+        if self.truncate:
+            # TRUNCATE commits immediately in Redshift, DELETE keeps the
+            # staging table intact if the COPY fails
+            statements.insert(0, f"DELETE FROM {self.table};")
+        return statements
+
+    def execute(self, context):
+        aws_hook = AwsHook(self.aws_credentials_id)
+        credentials = aws_hook.get_credentials()
+        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
+        # Set S3 path based on rendered key
+        rendered_key = self.s3_key.format(**context)
+        s3_path = "s3://{}/{}".format(self.s3_bucket, rendered_key)
+
+        if self.use_manifest:
+            manifest_key = self.manifest_key.format(table=self.table, **context)
+            s3_path = self.write_manifest(rendered_key, manifest_key)
 
-        self.log.info("Copying data from S3 to Redshift")
-        redshift.run(sql_staging)
+        self.log.info(f"Copying data from {s3_path} to Redshift")
+        redshift.run(self.copy_statements(s3_path, credentials), autocommit=False)
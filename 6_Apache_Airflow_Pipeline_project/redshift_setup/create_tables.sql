@@ -85,3 +85,11 @@ CREATE TABLE public.users (
 	"level" varchar(256),
 	CONSTRAINT users_pkey PRIMARY KEY (userid)
 );
+
+CREATE TABLE public.dq_metric_history (
+	table_name varchar(256) NOT NULL,
+	metric varchar(256) NOT NULL,
+	value float8,
+	passed boolean,
+	recorded_at timestamp NOT NULL
+);
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Import the operators and helpers like Airflow does, from the plugins folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "plugins"))
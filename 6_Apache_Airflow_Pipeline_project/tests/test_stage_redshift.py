@@ -0,0 +1,154 @@
+"""
+Offline tests of the manifest mode of StageToRedshiftOperator. S3 is
+emulated with moto, Redshift with a PostgresHook stand-in that records the
+statements it is asked to run.
+"""
+
+import json
+from collections import namedtuple
+import pytest
+
+pytest.importorskip("airflow")
+moto = pytest.importorskip("moto")
+boto3 = pytest.importorskip("boto3")
+
+from operators import stage_redshift  # noqa: E402
+from operators.stage_redshift import StageToRedshiftOperator  # noqa: E402
+
+# moto < 5 has a mock per service, moto >= 5 one for all of AWS
+mock_s3 = getattr(moto, "mock_s3", None) or moto.mock_aws
+
+Credentials = namedtuple("Credentials", ["access_key", "secret_key"])
+
+SONGS = {"song_data/A/A/A/TRAAAAW128F429D538.json": b'{"song_id": "S1"}',
+         "song_data/A/A/B/TRAABCL128F4286650.json": b'{"song_id": "S2"}',
+         "song_data/A/A/C/empty.json": b"",
+         "log_data/2018/11/2018-11-01-events.json": b'{"ts": 1}',
+         }
+
+
+class S3HookStandIn:
+    """S3Hook on the moto S3 client."""
+
+    def __init__(self, aws_conn_id=None):
+        self.client = boto3.client("s3", region_name="us-east-1")
+
+    def get_conn(self):
+        return self.client
+
+    def load_string(self, string_data, key, bucket_name, replace=False):
+        self.client.put_object(Bucket=bucket_name, Key=key,
+                               Body=string_data.encode("utf-8"))
+
+
+class AwsHookStandIn:
+    def __init__(self, aws_conn_id=None):
+        pass
+
+    def get_credentials(self):
+        return Credentials("KEY", "SECRET")
+
+
+class PostgresHookStandIn:
+    """Records the statements instead of running them on Redshift."""
+
+    runs = []
+
+    def __init__(self, postgres_conn_id=None):
+        pass
+
+    def run(self, sql, autocommit=False, parameters=None):
+        self.runs.append(sql)
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with mock_s3():
+        client = boto3.client("s3", region_name="us-east-1")
+        for bucket in ["udacity-dend", "manifests"]:
+            client.create_bucket(Bucket=bucket)
+        for key, body in SONGS.items():
+            client.put_object(Bucket="udacity-dend", Key=key, Body=body)
+        yield client
+
+
+@pytest.fixture
+def hooks(monkeypatch):
+    monkeypatch.setattr(stage_redshift, "S3Hook", S3HookStandIn)
+    monkeypatch.setattr(stage_redshift, "AwsHook", AwsHookStandIn)
+    monkeypatch.setattr(stage_redshift, "PostgresHook", PostgresHookStandIn)
+    PostgresHookStandIn.runs = []
+    return PostgresHookStandIn.runs
+
+
+def make_operator(s3_key="song_data/", **kwargs):
+    return StageToRedshiftOperator(task_id="stage_songs",
+                                   table="staging_songs",
+                                   s3_bucket="udacity-dend",
+                                   s3_key=s3_key,
+                                   **kwargs)
+
+
+def test_list_objects_skips_empty_objects_and_other_prefixes(s3):
+    objects = StageToRedshiftOperator.list_objects(S3HookStandIn(),
+                                                   "udacity-dend", "song_data/")
+    assert sorted(objects) == [
+        ("song_data/A/A/A/TRAAAAW128F429D538.json", 17),
+        ("song_data/A/A/B/TRAABCL128F4286650.json", 17),
+    ]
+
+
+def test_build_manifest():
+    manifest = json.loads(StageToRedshiftOperator.build_manifest(
+        "udacity-dend", [("song_data/a.json", 10), ("song_data/b.json", 20)]
+    ))
+    assert manifest == {"entries": [
+        {"url": "s3://udacity-dend/song_data/a.json", "mandatory": True,
+         "meta": {"content_length": 10}},
+        {"url": "s3://udacity-dend/song_data/b.json", "mandatory": True,
+         "meta": {"content_length": 20}},
+    ]}
+
+
+def test_copy_without_manifest(hooks):
+    make_operator().execute({"ds": "2018-11-01"})
+
+    (statements,) = hooks
+    assert len(statements) == 1
+    assert "FROM 's3://udacity-dend/song_data/'" in statements[0]
+    assert "MANIFEST" not in statements[0]
+
+
+def test_copy_with_manifest(s3, hooks):
+    operator = make_operator(use_manifest=True, manifest_bucket="manifests",
+                             truncate=True)
+    operator.execute({"ts_nodash": "20181101T000000"})
+
+    manifest_key = "manifests/staging_songs/20181101T000000.manifest"
+    manifest = json.loads(s3.get_object(Bucket="manifests", Key=manifest_key)
+                          ["Body"].read())
+    assert sorted(entry["url"] for entry in manifest["entries"]) == [
+        "s3://udacity-dend/song_data/A/A/A/TRAAAAW128F429D538.json",
+        "s3://udacity-dend/song_data/A/A/B/TRAABCL128F4286650.json",
+    ]
+
+    (statements,) = hooks
+    delete, copy = statements
+    assert delete == "DELETE FROM staging_songs;"
+    assert f"FROM 's3://manifests/{manifest_key}'" in copy
+    assert "MANIFEST" in copy
+
+
+def test_manifest_requires_objects(s3, hooks):
+    operator = make_operator(s3_key="song_data/Z/", use_manifest=True,
+                             manifest_bucket="manifests")
+    with pytest.raises(ValueError):
+        operator.execute({"ts_nodash": "20181101T000000"})
+    assert hooks == []
+
+
+def test_manifest_requires_bucket():
+    with pytest.raises(ValueError):
+        make_operator(use_manifest=True)
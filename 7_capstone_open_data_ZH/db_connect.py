@@ -1,11 +1,17 @@
-
-
 # The approach taken here has been inspired by:
 # https://www.postgresqltutorial.com/postgresql-python/connect/
 
+import os
+import sys
 import psycopg2
 from configparser import ConfigParser
 
+# The connection pool is shared with the other projects, see db_pool.py in
+# the repository root. Create it with db_params=connection_params(). Redshift
+# doesn't support WITH HOLD cursors, so named_cursor is not offered here.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from db_pool import ConnectionPool, is_healthy  # noqa: E402,F401
+
 
 def config(filename="dwh.cfg", section="CLUSTER"):
     """Read and return necessary parameters for connecting to the database."""
@@ -25,30 +31,32 @@ def config(filename="dwh.cfg", section="CLUSTER"):
     return db_params
 
 
-def connect():
-    """Connect to the Redshift cluster. Return cursor and connection objects."""
-    conn = None
-    try:
-        # Read connection parameters
-        db_params = config()
-        # Connect to the PostgreSQL server
-        conn = psycopg2.connect(
-            f"host={db_params.get('host')} \
-              dbname={db_params.get('db_name')} \
-              user={db_params.get('db_user')} \
-              password={db_params.get('db_password')} \
-              port={db_params.get('db_port')}"
-              )
-        # Set auto commit so that each action is commited without calling conn.commit()
-        conn.set_session(autocommit=True)
-        # Create a cursor
-        cur = conn.cursor()
-        print("Connected to database!")
-
-        return cur, conn
+def connection_params():
+    """Map the cluster config to keyword arguments for psycopg2.connect."""
+    db_params = config()
+    return {"host": db_params.get("host"),
+            "dbname": db_params.get("db_name"),
+            "user": db_params.get("db_user"),
+            "password": db_params.get("db_password"),
+            "port": db_params.get("db_port"),
+            }
 
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
+
+def connect(autocommit=True, cursor_factory=None):
+    """Connect to the Redshift cluster. Return cursor and connection objects.
+
+    With autocommit (default) each action is commited without calling
+    conn.commit(). Errors are raised, not swallowed. An optional psycopg2
+    cursor subclass can be passed as default cursor_factory.
+    """
+    conn = psycopg2.connect(**connection_params(),
+                            cursor_factory=cursor_factory)
+    conn.set_session(autocommit=autocommit)
+    # Create a cursor
+    cur = conn.cursor()
+    print("Connected to database!")
+
+    return cur, conn
 
 
 def close(cur, conn):
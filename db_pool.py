@@ -0,0 +1,116 @@
+"""
+Connection layer shared by the db_connect.py modules of the projects: a
+thread-safe connection pool with health checks and context-managed
+transactions, plus server-side cursors for large reads. The projects only
+define how their connection parameters are read, e.g.:
+
+    from db_pool import ConnectionPool
+    pool = ConnectionPool(1, 8, db_params=config())
+
+The project folders import it by adding the repository root to sys.path in
+their db_connect.py.
+"""
+
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
+
+
+def is_healthy(conn):
+    """Check if a connection is open and the server responds. The check runs
+    on a plain cursor, so counting cursor factories don't record it.
+    """
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+            cur.execute("SELECT 1;")
+        if not conn.autocommit:
+            conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+@contextmanager
+def named_cursor(conn, name, itersize=10000):
+    """Open a server-side cursor for large reads. Rows are fetched from the
+    server in batches of `itersize` while iterating over the cursor.
+
+    Server-side cursors live in a transaction. On autocommit connections the
+    cursor is declared WITH HOLD, so it survives the implicit commit. Not
+    supported by Redshift.
+    """
+    cur = conn.cursor(name=name, withhold=conn.autocommit)
+    cur.itersize = itersize
+    try:
+        yield cur
+    finally:
+        cur.close()
+
+
+class ConnectionPool:
+    """Thread-safe pool of database connections, shared by parallel loaders.
+
+    Connections are health-checked on checkout and replaced if broken.
+
+    Parameters
+    ----------
+    minconn : int
+        Number of connections opened upfront
+    maxconn : int
+        Maximum number of connections, i.e. of concurrent checkouts
+    db_params : dict
+        Keyword arguments for psycopg2.connect
+    cursor_factory : psycopg2 cursor subclass, optional
+        Default cursor class of the connections
+    """
+
+    def __init__(self, minconn=1, maxconn=4, db_params=None,
+                 cursor_factory=None):
+        if not db_params:
+            raise ValueError("db_params are required for a ConnectionPool.")
+        self._pool = ThreadedConnectionPool(minconn, maxconn, **db_params,
+                                            cursor_factory=cursor_factory)
+
+    def getconn(self):
+        """Check out a healthy connection."""
+        conn = self._pool.getconn()
+        if not is_healthy(conn):
+            self._pool.putconn(conn, close=True)
+            conn = self._pool.getconn()
+        return conn
+
+    def putconn(self, conn, close=False):
+        """Return a connection to the pool, open transactions are rolled back."""
+        self._pool.putconn(conn, close=close)
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of the with block."""
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    @contextmanager
+    def transaction(self):
+        """Yield a cursor running in a single transaction (autocommit off).
+        The transaction is committed at the end of the with block, or rolled
+        back if an exception is raised.
+        """
+        with self.connection() as conn:
+            conn.autocommit = False
+            try:
+                with conn.cursor() as cur:
+                    yield cur
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    def closeall(self):
+        """Close all connections of the pool."""
+        self._pool.closeall()